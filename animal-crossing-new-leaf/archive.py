@@ -1,57 +1,74 @@
 import os
+import sys
 import json
+import time
 import gzip
 import anyio
-import sqlite3
 import asyncio
 from dotenv import load_dotenv
 from nintendo.nex import backend, datastore, settings
-from anynet import http
+from manifest import Manifest
+from metadata_store import MetadataStore
+from blob_store import BlobStore
+from pending_ids import PendingIds
+from writer_stage import start_writer_stage
+from s3_download import ByteBudget, create_connection_pool, download_object
+from metrics import metrics, start_metrics_exporter
 
 load_dotenv()
 
 # * Dump using https://github.com/Stary2001/nex-dissector/tree/master/get_3ds_pid_password
 NEX_USERNAME = os.getenv("NEX_3DS_USERNAME")
 NEX_PASSWORD = os.getenv("NEX_3DS_PASSWORD")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0")) # * Set for the worker processes started for each account, see run_workers
 
 datastore_client = None # * Gets set later
-conn = None # * Gets set later
-cursor = None # * Gets set later
-
-def is_valid_json_file(path: str) -> bool:
-	try:
-		with open(path, "r") as json_file:
-			# * Attempt to load the JSON data
-			json.load(json_file)
-			return True
-	except json.JSONDecodeError:
-		return False
-	except FileNotFoundError:
-		return False
+pending_ids = None # * Gets set later
+writer_stage = None # * Gets set later
+download_budget = None # * Gets set later
+s3_pool = None # * Gets set later
+
+WRITER_THREADS = int(os.getenv("WRITER_THREADS", str(os.cpu_count() or 4))) # * Threads used to compress and write files
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", "256")) # * Writes which can wait for a thread before archiving is paused
+MAX_DOWNLOAD_BYTES_IN_FLIGHT = int(os.getenv("MAX_DOWNLOAD_BYTES_IN_FLIGHT", str(256 * 1024 * 1024))) # * New downloads wait once this many bytes are downloading
+S3_MAX_CONNECTIONS = int(os.getenv("S3_MAX_CONNECTIONS", "64")) # * Connections to S3 kept open at once
+S3_MAX_CONNECTIONS_PER_HOST = int(os.getenv("S3_MAX_CONNECTIONS_PER_HOST", "32"))
+S3_IDLE_TIMEOUT = float(os.getenv("S3_IDLE_TIMEOUT", "30")) # * Seconds before an unused connection is closed
+META_LOOKUPS_PER_REQUEST = 30 # * Data IDs sent in each GetMetasMultipleParam request, see get_metas
+META_LOOKAHEAD = int(os.getenv("META_LOOKAHEAD", "4")) # * Batches of metadata which can be looked up ahead of the batch being downloaded
+LEASE_SIZE = int(os.getenv("LEASE_SIZE", "10000")) # * Data IDs leased by a worker at a time
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", "300")) # * Leases not renewed for this long can be taken by other workers
+LEASE_POLL_SECONDS = 10 # * How often a worker with no IDs left checks if the other workers have finished
+DEDUP_OBJECTS = os.getenv("DEDUP_OBJECTS", "1") == "1" # * Store identical object data once, keyed by it's SHA-256
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # * Serve metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 to turn off
+METRICS_FILE = os.getenv("METRICS_FILE", "") # * Write metrics to this file every METRICS_INTERVAL seconds, empty to turn off
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+
+# * Every object has one of each of these written next to it
+SIDECARS = [ "metadata" ]
+
+manifest = Manifest("./manifest.db")
+metadata_store = MetadataStore("./metadata.db")
+blob_store = BlobStore("./blobs") if DEDUP_OBJECTS else None
+
+metrics.histogram("nex_rpc_seconds", "Time taken by each NEX request, by method")
+metrics.counter("archive_objects_total", "Objects seen, by if they were downloaded, skipped or missing")
+metrics.gauge("s3_bytes_in_flight", "Object bytes reserved by downloads in progress", lambda: download_budget.in_flight if download_budget is not None else 0)
 
 def should_download_object(data_id: int, expected_object_size: int, expected_object_version: int) -> bool:
-	object_path = "./objects/%d_v%d.bin" % (data_id, expected_object_version)
-	metadata_path = "./objects/%d_v%d_metadata.json" % (data_id, expected_object_version)
+	# * Only objects which had every file written are in the manifest
+	return not manifest.is_complete(data_id, expected_object_version, expected_object_size, SIDECARS)
 
-	if not os.path.exists(object_path):
-		return True
+def write_compressed_json(path: str, data: dict):
+	with gzip.open(path, "wb") as metadata_file:
+		metadata_file.write(json.dumps(data).encode("utf-8"))
 
-	if not os.path.exists(metadata_path):
-		return True
-
-	if os.path.getsize(object_path) != expected_object_size:
-		return True
-
-	if not is_valid_json_file(metadata_path):
-		return True
-
-	return False # * If nothing bails early, assume the object does not need to be redownloaded
-
-async def process_datastore_object(obj: datastore.DataStoreMetaInfo):
+async def process_datastore_object(obj: datastore.DataStoreMetaInfo, completed: list[tuple[int, dict, tuple[int, int, int, str, list[str]]]]):
 	param = datastore.DataStorePrepareGetParam()
 	param.data_id = obj.data_id
 
-	get_object_response = await datastore_client.prepare_get_object(param)
+	with metrics.time("nex_rpc_seconds", method="prepare_get_object"):
+		get_object_response = await datastore_client.prepare_get_object(param)
 
 	headers = {header.key: header.value for header in get_object_response.headers}
 	s3_url = get_object_response.url
@@ -60,13 +77,14 @@ async def process_datastore_object(obj: datastore.DataStoreMetaInfo):
 	if not should_download_object(get_object_response.data_id, get_object_response.size, object_version):
 		# * Object data already downloaded
 		print("Skipping %d" % get_object_response.data_id)
+		metrics.inc("archive_objects_total", result="skipped")
 		return
 
-	response = await http.get(s3_url, headers=headers)
+	object_path = "./objects/%d_v%d.bin" % (get_object_response.data_id, object_version)
+	checksum = await download_object(s3_url, headers, object_path, get_object_response.size, download_budget, s3_pool)
 
-	object_file = open("./objects/%d_v%d.bin" % (get_object_response.data_id, object_version), "wb")
-	object_file.write(response.body)
-	object_file.close()
+	if blob_store is not None:
+		await writer_stage.write(blob_store.add, object_path, checksum)
 
 	metadata = {
 		"data_id": obj.data_id,
@@ -118,15 +136,84 @@ async def process_datastore_object(obj: datastore.DataStoreMetaInfo):
 		]
 	}
 
-	with gzip.open("./objects/%d_v%d_metadata.json.gz" % (get_object_response.data_id, object_version), "wb") as metadata_file:
-		metadata_file.write(json.dumps(metadata).encode("utf-8"))
+	# * Compression and disk writes happen in the writer stage
+	await writer_stage.write(write_compressed_json, "./objects/%d_v%d_metadata.json.gz" % (get_object_response.data_id, object_version), metadata)
 
-async def process_pending_objects():
-	global cursor
+	# * Recorded once the whole batch is done, see record_batch
+	completed.append((object_version, metadata, (get_object_response.data_id, object_version, get_object_response.size, checksum, SIDECARS)))
+	metrics.inc("archive_objects_total", result="downloaded")
 
-	os.makedirs("./objects", exist_ok=True)
+async def get_metas_chunk(infos: dict[int, list[datastore.DataStoreMetaInfo]], index: int, data_ids: list[int]):
+	params = []
+
+	for data_id in data_ids:
+		param = datastore.DataStoreGetMetaParam()
+		param.data_id = data_id
+		param.result_option = 0xFF
+
+		params.append(param)
+
+	with metrics.time("nex_rpc_seconds", method="get_metas_multiple_param"):
+		metas = await datastore_client.get_metas_multiple_param(params)
+
+	infos[index] = metas.infos
+
+async def get_metas(data_ids: list[int]) -> list[datastore.DataStoreMetaInfo]:
+	# * NintendoClients sends each PRUDP fragment of a request on it's own, so
+	# * a request made in the meantime can be sent between them, and the
+	# * server gets both corrupted. Metadata is looked up while objects are
+	# * being downloaded, so requests are kept under one 1300 byte fragment,
+	# * which fits 38 data IDs at 33 bytes each. They are sent at once so a
+	# * batch still takes one round trip
+	infos = {}
+
+	async with anyio.create_task_group() as tg:
+		for i in range(0, len(data_ids), META_LOOKUPS_PER_REQUEST):
+			tg.start_soon(get_metas_chunk, infos, i, data_ids[i:i + META_LOOKUPS_PER_REQUEST])
+
+	return [obj for i in sorted(infos) for obj in infos[i]]
+
+def record_batch(completed: list[tuple[int, dict, tuple[int, int, int, str, list[str]]]]):
+	# * One short transaction per batch. Other workers can't write while a
+	# * transaction is open, so it is only started once the batch is done
+	metadata_store.record_many([(version, metadata) for version, metadata, row in completed])
+	metadata_store.commit()
+	manifest.record_many([row for version, metadata, row in completed])
+	manifest.commit()
+
+async def look_up_pending_batches(send_stream):
+	async with send_stream:
+		while True:
+			data_ids = pending_ids.claim(100)
+
+			if not data_ids:
+				# * The only IDs left may be leased by a worker which stopped, so
+				# * wait for it's leases to run out rather than leaving them unchecked
+				expires = pending_ids.other_leases_expire()
+
+				if expires is None or pending_ids.remaining() == 0:
+					break
+
+				# * Other workers usually finish their leases long before they run
+				# * out, so check again every LEASE_POLL_SECONDS
+				wait_seconds = min(max(expires - time.time(), 1), LEASE_POLL_SECONDS)
+				print("Waiting %d seconds for leases held by other workers" % wait_seconds)
+
+				await anyio.sleep(wait_seconds)
+				continue
 
-	cursor = conn.cursor()
+			objects = []
+
+			for obj in await get_metas(data_ids):
+				if obj.data_id == 0:
+					metrics.inc("archive_objects_total", result="missing")
+				else:
+					objects.append(obj)
+
+			await send_stream.send((data_ids, objects))
+
+async def process_pending_objects():
+	os.makedirs("./objects", exist_ok=True)
 
 	s = settings.default()
 	s.configure("d6f08b40", 31017)
@@ -134,65 +221,116 @@ async def process_pending_objects():
 	async with backend.connect(s, "52.40.192.64", "60000") as be: # * Skip NASC
 		async with be.login(NEX_USERNAME, NEX_PASSWORD) as client:
 			global datastore_client
+			global writer_stage
+			global download_budget
+			global s3_pool
 
 			datastore_client = datastore.DataStoreClient(client)
+			download_budget = ByteBudget(MAX_DOWNLOAD_BYTES_IN_FLIGHT)
 
-			while True:
-				cursor.execute("SELECT id FROM objects WHERE processed = 0 LIMIT 100")
-				rows = cursor.fetchall()
+			async with start_writer_stage(WRITER_THREADS, WRITER_QUEUE_SIZE) as stage, create_connection_pool(S3_MAX_CONNECTIONS, S3_MAX_CONNECTIONS_PER_HOST, S3_IDLE_TIMEOUT) as pool:
+				writer_stage = stage
+				s3_pool = pool
 
-				if not rows:
-					break
+				# * Metadata is looked up by it's own task, up to META_LOOKAHEAD
+				# * batches ahead, so the next batch is ready as soon as the
+				# * current one has downloaded. Batches with no objects cost
+				# * nothing more than marking them checked
+				send_stream, receive_stream = anyio.create_memory_object_stream(META_LOOKAHEAD)
 
-				print("Checking objects %d through %d" % (rows[0][0], rows[-1][0]))
+				async with anyio.create_task_group() as tg:
+					tg.start_soon(look_up_pending_batches, send_stream)
 
-				params = []
+					async with receive_stream:
+						async for data_ids, objects in receive_stream:
+							print("Checking objects %d through %d" % (data_ids[0], data_ids[-1]))
 
-				for row in rows:
-					data_id = row[0]
-					param = datastore.DataStoreGetMetaParam()
-					param.data_id = data_id
-					param.result_option = 0xFF
+							completed = []
 
-					params.append(param)
+							async with anyio.create_task_group() as batch_tg:
+								for obj in objects:
+									batch_tg.start_soon(process_datastore_object, obj, completed)
 
-				metas = await datastore_client.get_metas_multiple_param(params)
-				objects = []
+							# * The manifest must have the objects before the IDs are marked
+							# * checked, or a crash in between would lose them
+							record_batch(completed)
 
-				for i in range(len(rows)):
-					row = rows[i]
-					data_id = row[0]
+							# * Every ID in the batch has now been checked
+							pending_ids.mark_done(data_ids)
+							pending_ids.commit()
 
-					obj = metas.infos[i]
+			objects_remaining = pending_ids.remaining()
 
-					if obj.data_id == 0:
-						cursor.execute("UPDATE objects SET processed = 1 WHERE id = %d" % data_id)
-					else:
-						objects.append(obj)
+			if objects_remaining == 0:
+				print("All objects processed")
+			else:
+				print("The other %d objects are leased by other workers" % objects_remaining)
 
-				async with anyio.create_task_group() as tg:
-					for obj in objects:
-						tg.start_soon(process_datastore_object, obj)
+def read_credentials() -> list[tuple[str, str]]:
+	# * Extra accounts are set as NEX_3DS_USERNAME_2, NEX_3DS_PASSWORD_2 and so on
+	credentials = [(NEX_USERNAME, NEX_PASSWORD)]
+	account = 2
+
+	while os.getenv("NEX_3DS_USERNAME_%d" % account) and os.getenv("NEX_3DS_PASSWORD_%d" % account):
+		credentials.append((os.getenv("NEX_3DS_USERNAME_%d" % account), os.getenv("NEX_3DS_PASSWORD_%d" % account)))
+		account += 1
+
+	return credentials
 
-						cursor.execute("UPDATE objects SET processed = 1 WHERE id = %d" % obj.data_id)
+async def run_worker(failed_workers: list[str], env: dict[str, str]):
+	process = await anyio.run_process([sys.executable, os.path.abspath(__file__)], stdout=None, stderr=None, check=False, env=env)
 
-				conn.commit()
+	if process.returncode != 0:
+		print("Worker %s exited with %d" % (env["WORKER_INDEX"], process.returncode))
+		failed_workers.append(env["WORKER_INDEX"])
 
-			print("All objects processed")
+async def run_workers(credentials: list[tuple[str, str]]) -> list[str]:
+	# * Each account gets it's own worker process and NEX session. The workers
+	# * share objects.db and take data IDs to check through leases, so more
+	# * accounts check more IDs at once
+	failed_workers = []
+
+	async with anyio.create_task_group() as tg:
+		for i, (username, password) in enumerate(credentials):
+			env = dict(os.environ)
+			env["NEX_3DS_USERNAME"] = username
+			env["NEX_3DS_PASSWORD"] = password
+			env["WORKER_INDEX"] = str(i + 1)
+
+			# * Each worker exports it's own metrics
+			if METRICS_PORT != 0:
+				env["METRICS_PORT"] = str(METRICS_PORT + i)
+
+			if METRICS_FILE:
+				root, extension = os.path.splitext(METRICS_FILE)
+				env["METRICS_FILE"] = "%s-%d%s" % (root, i + 1, extension)
+
+			tg.start_soon(run_worker, failed_workers, env)
+
+	return failed_workers
 
 async def main():
-	global conn
+	global pending_ids
 
-	conn = sqlite3.connect("./objects.db")
-	cursor = conn.cursor()
+	credentials = read_credentials()
+
+	if len(credentials) > 1 and WORKER_INDEX == 0:
+		failed_workers = await run_workers(credentials)
+
+		if failed_workers:
+			sys.exit("These workers did not finish: %s" % ", ".join(failed_workers))
+
+		return
 
-	cursor.execute("SELECT COUNT(*) FROM objects WHERE processed = 0")
-	objects_remaining = cursor.fetchone()[0]
+	pending_ids = PendingIds("./objects.db", LEASE_SIZE, LEASE_SECONDS)
 
-	print("Number of objects left to check: %d" % objects_remaining)
+	print("Number of objects left to check: %d" % pending_ids.remaining())
 
-	await process_pending_objects()
+	async with start_metrics_exporter(metrics, METRICS_PORT, METRICS_FILE, METRICS_INTERVAL):
+		await process_pending_objects()
 
-	conn.close()
+	pending_ids.close()
+	manifest.close()
+	metadata_store.close()
 
 anyio.run(main)
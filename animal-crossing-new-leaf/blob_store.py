@@ -0,0 +1,62 @@
+import os
+import threading
+
+# * Stores each distinct object payload once, named by its SHA-256, and makes
+# * every object version file a hard link to the payload. Versions which only
+# * changed metadata, or objects re-uploaded unchanged, then take no extra
+# * space, while objects/{data_id}_v{version}.bin keeps working as before
+class BlobStore:
+	def __init__(self, path: str):
+		self.path = path
+		self.lock = threading.Lock() # * Writer threads may add the same payload at once
+
+		os.makedirs(path, exist_ok=True)
+
+	def blob_path(self, checksum: str) -> str:
+		# * Split over 256 directories so none of them get too large
+		return os.path.join(self.path, checksum[:2], checksum + ".bin")
+
+	def add(self, path: str, checksum: str):
+		# * "path" must be a complete file whose contents hash to "checksum"
+		with self.lock:
+			self.link(path, checksum)
+
+	def link(self, path: str, checksum: str):
+		blob_path = self.blob_path(checksum)
+
+		if os.path.isfile(blob_path) and os.path.getsize(blob_path) == os.path.getsize(path):
+			if os.path.samefile(blob_path, path):
+				return
+
+			# * Already stored. Swap the new copy for a link to the stored one. The
+			# * link is made next to "path" and renamed over it, so "path" is never
+			# * missing or incomplete
+			temp_path = path + ".link"
+
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+
+			try:
+				os.link(blob_path, temp_path)
+			except OSError:
+				# * Hard links are not supported here, keep the copy
+				return
+
+			os.replace(temp_path, path)
+			return
+
+		os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+		# * Named by process, as other processes may be adding the same payload
+		temp_path = blob_path + ".%d.tmp" % os.getpid()
+
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+
+		try:
+			os.link(path, temp_path)
+		except OSError:
+			# * Hard links are not supported here, so nothing can be shared
+			return
+
+		os.replace(temp_path, blob_path)
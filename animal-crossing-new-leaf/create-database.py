@@ -1,8 +1,8 @@
 import os
 import anyio
-import sqlite3
 from dotenv import load_dotenv
 from nintendo.nex import backend, datastore, settings
+from pending_ids import PendingIds
 
 load_dotenv()
 
@@ -11,16 +11,8 @@ NEX_USERNAME = os.getenv("NEX_3DS_USERNAME")
 NEX_PASSWORD = os.getenv("NEX_3DS_PASSWORD")
 datastore_client = None # * Gets set later
 
-conn = sqlite3.connect("./objects.db")
-cursor = conn.cursor()
-
-cursor.execute('''
-	CREATE TABLE IF NOT EXISTS objects (
-		id INTEGER PRIMARY KEY,
-		processed BOOLEAN DEFAULT 0
-	)
-''')
-conn.commit()
+# * Only the ranges of IDs left to check are stored, so adding millions of IDs is one row
+pending_ids = PendingIds("./objects.db")
 
 async def main():
 	s = settings.default()
@@ -32,8 +24,8 @@ async def main():
 
 			datastore_client = datastore.DataStoreClient(client)
 
-			cursor.execute("SELECT *, MAX(id) FROM objects")
-			start_data_id = cursor.fetchone()[0]
+			# * Continue from the end of the last run, only adding IDs uploaded since
+			start_data_id = pending_ids.end_id()
 
 			if start_data_id is None:
 				param = datastore.DataStoreSearchParam()
@@ -62,9 +54,9 @@ async def main():
 
 			await client.disconnect()
 
-			for data_id in range(start_data_id, end_data_id+1):
-				cursor.execute("INSERT INTO objects (id) VALUES (%d) ON CONFLICT (id) DO NOTHING" % data_id)
+			pending_ids.add_range(start_data_id, end_data_id + 1)
+			print("Number of objects left to check: %d" % pending_ids.remaining())
 
-			conn.commit()
+			pending_ids.close()
 
 anyio.run(main)
@@ -0,0 +1,56 @@
+import os
+import re
+import hashlib
+from manifest import Manifest
+from blob_store import BlobStore
+
+# * Moves the objects of an archive made before ./blobs existed into the blob
+# * store, so identical object data already on disk is only stored once.
+# * Checksums are taken from manifest.db where possible. Safe to run more than once
+
+OBJECT_FILE_NAME = re.compile(r"^(\d+)_v(\d+)\.bin$")
+
+def hash_file(path: str) -> str:
+	sha256 = hashlib.sha256()
+
+	with open(path, "rb") as object_file:
+		for chunk in iter(lambda: object_file.read(1024 * 1024), b""):
+			sha256.update(chunk)
+
+	return sha256.hexdigest()
+
+def main():
+	manifest = Manifest("manifest.db")
+	blob_store = BlobStore("./blobs")
+	checked = 0
+	saved = 0
+
+	with os.scandir("./objects") as entries:
+		for entry in entries:
+			match = OBJECT_FILE_NAME.match(entry.name)
+
+			if not match:
+				continue
+
+			checksum = manifest.checksum(int(match.group(1)), int(match.group(2)))
+
+			if checksum is None:
+				checksum = hash_file(entry.path)
+
+			links = entry.stat().st_nlink
+			blob_store.add(entry.path, checksum)
+
+			if links == 1 and os.stat(entry.path).st_nlink > 2:
+				# * Was its own copy, and now shares a blob with another object
+				saved += entry.stat().st_size
+
+			checked += 1
+
+			if checked % 10000 == 0:
+				print("Checked %d objects" % checked)
+
+	manifest.close()
+
+	print("Checked %d objects, freed %.1f MiB" % (checked, saved / (1024 * 1024)))
+
+main()
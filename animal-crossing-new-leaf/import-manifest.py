@@ -0,0 +1,64 @@
+import os
+import re
+import hashlib
+from manifest import Manifest
+
+# * Builds manifest.db from an archive made before the manifest existed.
+# * Only needs to be ran once. The objects directory is listed once, rather
+# * than checking every file on it's own
+
+OBJECT_FILE_NAME = re.compile(r"^(\d+)_v(\d+)\.bin$")
+METADATA_FILE_NAME = re.compile(r"^(\d+)_v(\d+)_metadata\.json\.gz$")
+BATCH_SIZE = 10000
+
+def hash_file(path: str) -> str:
+	sha256 = hashlib.sha256()
+
+	with open(path, "rb") as object_file:
+		for chunk in iter(lambda: object_file.read(1024 * 1024), b""):
+			sha256.update(chunk)
+
+	return sha256.hexdigest()
+
+def main():
+	manifest = Manifest("./manifest.db")
+	objects = []
+	metadata = set()
+
+	# * Objects and their metadata live in the same directory
+	with os.scandir("./objects") as entries:
+		for entry in entries:
+			match = OBJECT_FILE_NAME.match(entry.name)
+
+			if match:
+				objects.append((int(match.group(1)), int(match.group(2)), entry))
+				continue
+
+			match = METADATA_FILE_NAME.match(entry.name)
+
+			if match:
+				metadata.add((int(match.group(1)), int(match.group(2))))
+
+	rows = []
+	imported = 0
+
+	for data_id, version, entry in objects:
+		sidecars = [ "metadata" ] if (data_id, version) in metadata else []
+
+		rows.append((data_id, version, entry.stat().st_size, hash_file(entry.path), sidecars))
+
+		if len(rows) >= BATCH_SIZE:
+			manifest.record_many(rows)
+			manifest.commit()
+			imported += len(rows)
+			rows = []
+
+			print("Imported %d objects" % imported)
+
+	manifest.record_many(rows)
+	manifest.close()
+	imported += len(rows)
+
+	print("Imported %d objects" % imported)
+
+main()
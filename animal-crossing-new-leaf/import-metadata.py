@@ -0,0 +1,43 @@
+import os
+import re
+import gzip
+import json
+from metadata_store import MetadataStore
+
+# * Builds metadata.db from the metadata files of an archive made before
+# * metadata.db existed. Safe to run more than once
+
+METADATA_FILE_NAME = re.compile(r"^(\d+)_v(\d+)_metadata\.json\.gz$")
+BATCH_SIZE = 10000
+
+def main():
+	metadata_store = MetadataStore("./metadata.db")
+	rows = []
+	imported = 0
+
+	# * Metadata lives next to the objects
+	with os.scandir("./objects") as entries:
+		for entry in entries:
+			match = METADATA_FILE_NAME.match(entry.name)
+
+			if not match:
+				continue
+
+			with gzip.open(entry.path, "rb") as metadata_file:
+				rows.append((int(match.group(2)), json.loads(metadata_file.read())))
+
+			if len(rows) >= BATCH_SIZE:
+				metadata_store.record_many(rows)
+				metadata_store.commit()
+				imported += len(rows)
+				rows = []
+
+				print("Imported %d objects" % imported)
+
+	metadata_store.record_many(rows)
+	metadata_store.close()
+	imported += len(rows)
+
+	print("Imported %d objects" % imported)
+
+main()
@@ -0,0 +1,136 @@
+import json
+import sqlite3
+
+TIME_FIELDS = [ "create_time", "update_time", "referred_time", "expire_time" ]
+
+# * Keeps the metadata of every archived object version in one indexed SQLite
+# * database, so it can be queried without opening a file per object. Rows are
+# * built from the same dict which is written to the objects metadata file.
+# * Times are stored both as "YYYY-MM-DD HH:MM:SS" for SQLite's date functions
+# * and as the original DateTime value
+class MetadataStore:
+	def __init__(self, path: str):
+		self.conn = sqlite3.connect(path, timeout=60) # * Other processes only hold the database for a moment
+
+		# * Other processes can have the database open too. With WAL, reads never wait
+		# * for a writer and a commit is an append instead of rewriting pages
+		self.conn.execute("PRAGMA journal_mode = WAL")
+
+		self.conn.executescript("""
+			CREATE TABLE IF NOT EXISTS objects (
+				data_id INTEGER NOT NULL,
+				version INTEGER NOT NULL,
+				owner_id INTEGER NOT NULL,
+				size INTEGER NOT NULL,
+				name TEXT NOT NULL,
+				data_type INTEGER NOT NULL,
+				meta_binary BLOB NOT NULL,
+				permission INTEGER NOT NULL,
+				permission_recipients TEXT NOT NULL,
+				delete_permission INTEGER NOT NULL,
+				delete_permission_recipients TEXT NOT NULL,
+				create_time TEXT NOT NULL,
+				create_time_value INTEGER NOT NULL,
+				update_time TEXT NOT NULL,
+				update_time_value INTEGER NOT NULL,
+				period INTEGER NOT NULL,
+				status INTEGER NOT NULL,
+				referred_count INTEGER NOT NULL,
+				refer_data_id INTEGER NOT NULL,
+				flag INTEGER NOT NULL,
+				referred_time TEXT NOT NULL,
+				referred_time_value INTEGER NOT NULL,
+				expire_time TEXT NOT NULL,
+				expire_time_value INTEGER NOT NULL,
+				PRIMARY KEY (data_id, version)
+			);
+
+			CREATE TABLE IF NOT EXISTS ratings (
+				data_id INTEGER NOT NULL,
+				version INTEGER NOT NULL,
+				slot INTEGER NOT NULL,
+				total_value INTEGER NOT NULL,
+				count INTEGER NOT NULL,
+				initial_value INTEGER NOT NULL,
+				PRIMARY KEY (data_id, version, slot)
+			);
+
+			CREATE TABLE IF NOT EXISTS tags (
+				data_id INTEGER NOT NULL,
+				version INTEGER NOT NULL,
+				tag TEXT NOT NULL
+			);
+
+			CREATE INDEX IF NOT EXISTS objects_data_type ON objects (data_type);
+			CREATE INDEX IF NOT EXISTS objects_owner_id ON objects (owner_id);
+			CREATE INDEX IF NOT EXISTS objects_create_time ON objects (create_time);
+			CREATE INDEX IF NOT EXISTS objects_update_time ON objects (update_time);
+			CREATE INDEX IF NOT EXISTS ratings_slot_total_value ON ratings (slot, total_value);
+			CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+			CREATE INDEX IF NOT EXISTS tags_object ON tags (data_id, version);
+		""")
+		self.conn.commit()
+
+	def record(self, version: int, metadata: dict):
+		self.record_many([(version, metadata)])
+
+	def record_many(self, rows: list[tuple[int, dict]]):
+		objects = []
+		ratings = []
+		tags = []
+		keys = []
+
+		for version, metadata in rows:
+			data_id = metadata["data_id"]
+			row = [
+				data_id,
+				version,
+				metadata["owner_id"],
+				metadata["size"],
+				metadata["name"],
+				metadata["data_type"],
+				bytes.fromhex(metadata["meta_binary"]),
+				metadata["permission"]["permission"],
+				json.dumps(metadata["permission"]["recipients"]),
+				metadata["delete_permission"]["permission"],
+				json.dumps(metadata["delete_permission"]["recipients"]),
+			]
+
+			for field in TIME_FIELDS[:2]:
+				row += [metadata[field]["standard"], metadata[field]["original_value"]]
+
+			row += [metadata["period"], metadata["status"], metadata["referred_count"], metadata["refer_data_id"], metadata["flag"]]
+
+			for field in TIME_FIELDS[2:]:
+				row += [metadata[field]["standard"], metadata[field]["original_value"]]
+
+			objects.append(row)
+			keys.append((data_id, version))
+			ratings += [(data_id, version, rating["slot"], rating["info"]["total_value"], rating["info"]["count"], rating["info"]["initial_value"]) for rating in metadata["ratings"]]
+			tags += [(data_id, version, tag) for tag in metadata["tags"]]
+
+		# * Versions can be recorded again, so replace their old ratings and tags
+		self.conn.executemany("DELETE FROM ratings WHERE data_id = ? AND version = ?", keys)
+		self.conn.executemany("DELETE FROM tags WHERE data_id = ? AND version = ?", keys)
+		self.conn.executemany("INSERT OR REPLACE INTO objects VALUES (%s)" % ", ".join(["?"] * 24), objects)
+		self.conn.executemany("INSERT INTO ratings VALUES (?, ?, ?, ?, ?, ?)", ratings)
+		self.conn.executemany("INSERT INTO tags VALUES (?, ?, ?)", tags)
+
+	def last_seen(self, data_id: int) -> tuple[int, int, int, dict[int, tuple[int, int]]] | None:
+		# * Version, size, update time and {slot: (total_value, count)} of the newest version recorded
+		row = self.conn.execute("SELECT version, size, update_time_value FROM objects WHERE data_id = ? ORDER BY version DESC LIMIT 1", (data_id,)).fetchone()
+
+		if row is None:
+			return None
+
+		version, size, update_time = row
+		ratings = self.conn.execute("SELECT slot, total_value, count FROM ratings WHERE data_id = ? AND version = ?", (data_id, version)).fetchall()
+
+		return version, size, update_time, {slot: (total_value, count) for slot, total_value, count in ratings}
+
+	def commit(self):
+		self.conn.commit()
+
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
@@ -0,0 +1,315 @@
+import os
+import time
+import socket
+import sqlite3
+
+# * Keeps the data IDs which still need to be checked as sorted, non overlapping
+# * [start_id, end_id) ranges instead of one row per ID. A new sweep is a single
+# * row no matter how many IDs it covers, and checked IDs are cut out of the
+# * range they are in, so the table only grows with the gaps left behind.
+# * Several workers can share the database. Each one leases spans of up to
+# * "lease_size" IDs and only claims IDs from its own leases. Leases are
+# * renewed whenever the worker claims or checks IDs, and a lease which has
+# * not been renewed for "lease_seconds" can be taken by any worker, so IDs
+# * leased by a worker which stopped are not lost
+class PendingIds:
+	def __init__(self, path: str, lease_size: int = 10000, lease_seconds: float = 300):
+		self.conn = sqlite3.connect(path, timeout=60) # * Other workers only hold the database for a moment
+
+		# * Commits happen after every batch, with WAL they are an append
+		# * instead of rewriting pages in place. Losing the last few commits
+		# * in a power cut only means those IDs are checked again
+		self.conn.execute("PRAGMA journal_mode = WAL")
+		self.conn.execute("PRAGMA synchronous = NORMAL")
+
+		self.conn.executescript("""
+			CREATE TABLE IF NOT EXISTS pending_ranges (
+				start_id INTEGER PRIMARY KEY,
+				end_id INTEGER NOT NULL
+			);
+
+			CREATE INDEX IF NOT EXISTS pending_ranges_end_id ON pending_ranges (end_id);
+
+			CREATE TABLE IF NOT EXISTS id_space (
+				end_id INTEGER NOT NULL
+			);
+
+			CREATE TABLE IF NOT EXISTS leases (
+				start_id INTEGER PRIMARY KEY,
+				end_id INTEGER NOT NULL,
+				worker TEXT NOT NULL,
+				expires REAL NOT NULL
+			);
+		""")
+		self.conn.commit()
+
+		self.worker = "%s-%d" % (socket.gethostname(), os.getpid())
+		self.lease_size = lease_size
+		self.lease_seconds = lease_seconds
+		self.lease_end_id = None # * End of the lease IDs are being claimed from
+		self.claimed_until = 0 # * IDs below this in the lease have already been handed out by claim
+
+		self.import_objects_table()
+
+	def import_objects_table(self):
+		# * Databases made before pending_ranges existed have one row per ID
+		row = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'objects'").fetchone()
+
+		if row is None:
+			return
+
+		print("Converting the objects table to ID ranges, this only happens once")
+
+		ranges = []
+
+		for (data_id,) in self.conn.execute("SELECT id FROM objects WHERE processed = 0 ORDER BY id"):
+			if ranges and ranges[-1][1] == data_id:
+				ranges[-1][1] = data_id + 1
+			else:
+				ranges.append([data_id, data_id + 1])
+
+		end_id = self.conn.execute("SELECT MAX(id) FROM objects").fetchone()[0]
+
+		self.conn.executemany("INSERT OR REPLACE INTO pending_ranges (start_id, end_id) VALUES (?, ?)", ranges)
+
+		if end_id is not None:
+			self.set_end_id(end_id + 1)
+
+		self.conn.execute("DROP TABLE objects")
+		self.conn.commit()
+
+		# * Give the space used by the old table back to the filesystem
+		self.conn.execute("VACUUM")
+
+	def end_id(self) -> int | None:
+		# * One past the highest ID ever added, or None if nothing was added yet
+		row = self.conn.execute("SELECT end_id FROM id_space").fetchone()
+
+		return None if row is None else row[0]
+
+	def set_end_id(self, end_id: int):
+		self.conn.execute("DELETE FROM id_space")
+		self.conn.execute("INSERT INTO id_space (end_id) VALUES (?)", (end_id,))
+
+	def add_range(self, start_id: int, end_id: int):
+		if start_id >= end_id:
+			return
+
+		# * Merge with every range which overlaps or touches the new one
+		rows = self.ranges_touching(start_id, end_id)
+
+		for row_start_id, row_end_id in rows:
+			start_id = min(start_id, row_start_id)
+			end_id = max(end_id, row_end_id)
+
+		self.conn.executemany("DELETE FROM pending_ranges WHERE start_id = ?", [(row[0],) for row in rows])
+		self.conn.execute("INSERT INTO pending_ranges (start_id, end_id) VALUES (?, ?)", (start_id, end_id))
+
+		if self.end_id() is None or end_id > self.end_id():
+			self.set_end_id(end_id)
+
+	def ranges_touching(self, start_id: int, end_id: int) -> list[tuple[int, int]]:
+		# * Filtering on both columns makes SQLite walk the primary key from
+		# * the lowest range, over every gap left behind. Walking end_id
+		# * instead starts at the first match and stops after the last one
+		rows = []
+
+		for row in self.conn.execute("SELECT start_id, end_id FROM pending_ranges WHERE end_id >= ? ORDER BY end_id", (start_id,)):
+			if row[0] > end_id:
+				break
+
+			rows.append(row)
+
+		return rows
+
+	def claim(self, count: int) -> list[int]:
+		# * The next "count" pending IDs, in order, from this workers leases.
+		# * Claimed IDs stay pending until mark_done, so if the archiver stops
+		# * before then they are checked again on the next run. An empty list
+		# * means every pending ID is checked or leased by another worker
+		data_ids = []
+
+		while len(data_ids) < count:
+			if self.lease_end_id is None or self.claimed_until >= self.lease_end_id:
+				if not self.take_lease():
+					break
+
+			data_ids += self.claim_from_lease(count - len(data_ids))
+
+		self.renew_leases()
+
+		return data_ids
+
+	def claim_from_lease(self, count: int) -> list[int]:
+		# * Ranges never overlap, so ordering by end_id is the same as by
+		# * start_id, and the index finds where the last claim stopped
+		# * without a scan
+		data_ids = []
+		rows = self.conn.execute("SELECT start_id, end_id FROM pending_ranges WHERE end_id > ? ORDER BY end_id", (self.claimed_until,))
+
+		for start_id, end_id in rows:
+			start_id = max(start_id, self.claimed_until)
+			end_id = min(end_id, self.lease_end_id)
+
+			if start_id >= end_id:
+				break
+
+			taken = min(end_id - start_id, count - len(data_ids))
+
+			data_ids.extend(range(start_id, start_id + taken))
+			self.claimed_until = start_id + taken
+
+			if len(data_ids) == count:
+				break
+
+		rows.close()
+
+		if len(data_ids) < count:
+			# * Nothing else is pending in this lease
+			self.claimed_until = self.lease_end_id
+
+		return data_ids
+
+	def take_lease(self) -> bool:
+		# * Leases the lowest pending IDs which no live lease covers. This is one
+		# * write transaction, so two workers can never lease the same IDs
+		self.conn.commit()
+		self.conn.execute("BEGIN IMMEDIATE")
+
+		now = time.time()
+		self.conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+		self.release_dead_leases()
+
+		start_id = 0
+
+		while True:
+			row = self.conn.execute("SELECT start_id FROM pending_ranges WHERE end_id > ? ORDER BY end_id LIMIT 1", (start_id,)).fetchone()
+
+			if row is None:
+				self.conn.commit()
+				return False
+
+			start_id = max(start_id, row[0])
+			lease = self.conn.execute("SELECT end_id FROM leases WHERE start_id <= ? AND end_id > ?", (start_id, start_id)).fetchone()
+
+			if lease is None:
+				break
+
+			start_id = lease[0]
+
+		# * Stop short of the next lease, if it is closer than lease_size
+		next_lease_start_id = self.conn.execute("SELECT MIN(start_id) FROM leases WHERE start_id > ?", (start_id,)).fetchone()[0]
+		end_id = start_id + self.lease_size
+
+		if next_lease_start_id is not None:
+			end_id = min(end_id, next_lease_start_id)
+
+		self.conn.execute("INSERT INTO leases (start_id, end_id, worker, expires) VALUES (?, ?, ?, ?)", (start_id, end_id, self.worker, now + self.lease_seconds))
+		self.conn.commit()
+
+		self.claimed_until = start_id
+		self.lease_end_id = end_id
+
+		return True
+
+	def release_dead_leases(self):
+		# * Leases of workers on this machine whose process is gone, for
+		# * example after a crash, can be taken without waiting for them to expire
+		hostname = socket.gethostname()
+
+		for (worker,) in self.conn.execute("SELECT DISTINCT worker FROM leases").fetchall():
+			worker_hostname, _, pid = worker.rpartition("-")
+
+			if worker_hostname == hostname and not process_exists(int(pid)):
+				self.conn.execute("DELETE FROM leases WHERE worker = ?", (worker,))
+
+	def other_leases_expire(self) -> float | None:
+		# * When the first lease held by another worker runs out, or None if there are none
+		return self.conn.execute("SELECT MIN(expires) FROM leases WHERE worker != ?", (self.worker,)).fetchone()[0]
+
+	def renew_leases(self):
+		self.conn.execute("UPDATE leases SET expires = ? WHERE worker = ?", (time.time() + self.lease_seconds, self.worker))
+		self.conn.commit()
+
+	def release_finished_leases(self):
+		# * A lease is kept until every ID in it has been checked, not just
+		# * claimed, so no other worker takes IDs which are still being checked
+		leases = self.conn.execute("SELECT start_id, end_id FROM leases WHERE worker = ?", (self.worker,)).fetchall()
+
+		for start_id, end_id in leases:
+			row = self.conn.execute("SELECT start_id FROM pending_ranges WHERE end_id > ? ORDER BY end_id LIMIT 1", (start_id,)).fetchone()
+
+			if row is None or row[0] >= end_id:
+				self.conn.execute("DELETE FROM leases WHERE start_id = ?", (start_id,))
+
+	def mark_done(self, data_ids: list[int]):
+		done = coalesce(data_ids)
+
+		if not done:
+			return
+
+		# * Every range touched by the batch is read at once and replaced by
+		# * what is left of it, so a batch costs the same however far the
+		# * sweep has got
+		rows = self.ranges_touching(done[0][0], done[-1][1])
+		remaining = []
+
+		for row_start_id, row_end_id in rows:
+			for start_id, end_id in done:
+				# * Ranges which only touch the batch are put back unchanged
+				if end_id <= row_start_id or start_id >= row_end_id:
+					continue
+
+				# * Keep whatever is left before the checked IDs
+				if row_start_id < start_id:
+					remaining.append((row_start_id, start_id))
+
+				row_start_id = end_id
+
+			if row_start_id < row_end_id:
+				remaining.append((row_start_id, row_end_id))
+
+		self.conn.executemany("DELETE FROM pending_ranges WHERE start_id = ?", [(row[0],) for row in rows])
+		self.conn.executemany("INSERT INTO pending_ranges (start_id, end_id) VALUES (?, ?)", remaining)
+
+		self.release_finished_leases()
+		self.renew_leases()
+
+	def remaining(self) -> int:
+		return self.conn.execute("SELECT COALESCE(SUM(end_id - start_id), 0) FROM pending_ranges").fetchone()[0]
+
+	def commit(self):
+		self.conn.commit()
+
+	def close(self):
+		# * Anything still leased was not checked, let other workers have it
+		self.conn.execute("DELETE FROM leases WHERE worker = ?", (self.worker,))
+		self.conn.commit()
+		self.conn.close()
+
+def process_exists(pid: int) -> bool:
+	if os.name != "posix":
+		# * os.kill ends the process on Windows instead of checking it
+		return True
+
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		# * Running as another user
+		return True
+
+	return True
+
+def coalesce(data_ids: list[int]) -> list[tuple[int, int]]:
+	# * Turns IDs into as few [start_id, end_id) ranges as possible
+	ranges = []
+
+	for data_id in sorted(data_ids):
+		if ranges and ranges[-1][1] >= data_id:
+			ranges[-1][1] = max(ranges[-1][1], data_id + 1)
+		else:
+			ranges.append([data_id, data_id + 1])
+
+	return [(start_id, end_id) for start_id, end_id in ranges]
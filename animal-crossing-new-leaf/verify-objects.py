@@ -0,0 +1,174 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import concurrent.futures
+from dotenv import load_dotenv
+from manifest import Manifest
+from pending_ids import PendingIds, coalesce
+
+load_dotenv()
+
+# * Checks every object in manifest.db against the files on disk, using a pool
+# * of processes so the whole archive is read at disk speed. Broken objects are
+# * removed from the manifest and their data IDs are added back to objects.db,
+# * so the next run of archive.py downloads only those. Files in ./objects with
+# * no manifest entry are listed and queued the same way. An archive made before
+# * the manifest existed needs import-manifest.py ran first. Safe to run more than once
+
+VERIFY_PROCESSES = int(os.getenv("VERIFY_PROCESSES", str(os.cpu_count() or 4))) # * Processes used to check files
+VERIFY_CHECKSUMS = os.getenv("VERIFY_CHECKSUMS", "0") == "1" # * Also hash every object, reads the whole archive
+REQUEUE_BROKEN = os.getenv("REQUEUE_BROKEN", "1") == "1" # * Queue broken objects to be downloaded again, 0 to only list them
+CHUNK_SIZE = 1000 # * Objects sent to a process at a time
+
+SIDECAR_PATHS = {
+	"metadata": "./objects/%d_v%d_metadata.json.gz"
+}
+
+# * Same as import-manifest.py
+OBJECT_FILE_NAME = re.compile(r"^(\d+)_v(\d+)\.bin$")
+METADATA_FILE_NAME = re.compile(r"^(\d+)_v(\d+)_metadata\.json\.gz$")
+
+def hash_file(path: str) -> str:
+	sha256 = hashlib.sha256()
+
+	with open(path, "rb") as object_file:
+		for chunk in iter(lambda: object_file.read(1024 * 1024), b""):
+			sha256.update(chunk)
+
+	return sha256.hexdigest()
+
+def check_object(data_id: int, version: int, size: int, checksum: str, sidecars: list[str]) -> str | None:
+	# * What is wrong with the object, or None if nothing is
+	object_path = "./objects/%d_v%d.bin" % (data_id, version)
+
+	try:
+		object_size = os.stat(object_path).st_size
+	except FileNotFoundError:
+		return "object file is missing"
+
+	if object_size != size:
+		return "object is %d bytes, expected %d" % (object_size, size)
+
+	if VERIFY_CHECKSUMS and hash_file(object_path) != checksum:
+		return "object checksum does not match"
+
+	for sidecar in sidecars:
+		try:
+			with gzip.open(SIDECAR_PATHS[sidecar] % (data_id, version), "rb") as sidecar_file:
+				data = json.loads(sidecar_file.read())
+		except FileNotFoundError:
+			return "%s file is missing" % sidecar
+		except (OSError, EOFError, ValueError) as e:
+			# * gzip raises OSError and EOFError for bad or cut off files, json raises ValueError
+			return "%s file is unreadable: %s" % (sidecar, e)
+
+		if data.get("data_id") != data_id:
+			return "%s file is for data ID %s" % (sidecar, data.get("data_id"))
+
+	return None
+
+def check_objects(rows: list[tuple[int, int, int, str, list[str]]]) -> list[tuple[int, int, str]]:
+	broken = []
+
+	for data_id, version, size, checksum, sidecars in rows:
+		problem = check_object(data_id, version, size, checksum, sidecars)
+
+		if problem is not None:
+			broken.append((data_id, version, problem))
+
+	return broken
+
+def find_unrecorded_files(manifest: Manifest) -> list[tuple[int, int, str]]:
+	# * Files written by a run which stopped before recording them. The
+	# * manifest is how archive.py knows an object is done, so they would
+	# * otherwise only be looked at again if their IDs are checked again
+	unrecorded = {}
+
+	with os.scandir("./objects") as entries:
+		for entry in entries:
+			match = OBJECT_FILE_NAME.match(entry.name) or METADATA_FILE_NAME.match(entry.name)
+
+			if match is None:
+				continue
+
+			data_id = int(match.group(1))
+			version = int(match.group(2))
+
+			if manifest.checksum(data_id, version) is None:
+				unrecorded.setdefault((data_id, version), []).append(entry.name)
+
+	return [(data_id, version, "%s not in manifest.db" % ", ".join(sorted(names))) for (data_id, version), names in unrecorded.items()]
+
+def main():
+	manifest = Manifest("./manifest.db")
+	broken = []
+	total = 0
+	checked = 0
+
+	with concurrent.futures.ProcessPoolExecutor(VERIFY_PROCESSES) as executor:
+		futures = set()
+		rows = []
+
+		for row in manifest.entries():
+			rows.append(row)
+			total += 1
+
+			if len(rows) < CHUNK_SIZE:
+				continue
+
+			futures.add(executor.submit(check_objects, rows))
+			rows = []
+
+			# * Only read as far ahead of the processes as they can keep up with
+			if len(futures) >= VERIFY_PROCESSES * 2:
+				done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+				for future in done:
+					broken += future.result()
+					checked += CHUNK_SIZE
+
+					if checked % 10000 == 0:
+						print("Checked %d objects, %d broken" % (checked, len(broken)))
+
+		if rows:
+			futures.add(executor.submit(check_objects, rows))
+
+		for future in concurrent.futures.as_completed(futures):
+			broken += future.result()
+
+	if total == 0:
+		# * Every file would be listed as unrecorded
+		print("manifest.db is empty. Run import-manifest.py first if the archive was made before the manifest existed")
+		unrecorded = []
+	else:
+		unrecorded = find_unrecorded_files(manifest)
+
+	for data_id, version, problem in sorted(broken + unrecorded):
+		print("%d version %d: %s" % (data_id, version, problem))
+
+	if (broken or unrecorded) and REQUEUE_BROKEN:
+		# * The manifest is how archive.py knows an object is downloaded, and
+		# * objects.db is how it knows which data IDs to look at, so both are needed
+		manifest.remove_many([(data_id, version) for data_id, version, problem in broken])
+
+		# * Without objects.db, create-database.py has not been ran yet and
+		# * every ID will be checked anyway
+		if os.path.exists("./objects.db"):
+			pending_ids = PendingIds("./objects.db")
+
+			for start_id, end_id in coalesce([data_id for data_id, version, problem in broken + unrecorded]):
+				pending_ids.add_range(start_id, end_id)
+
+			pending_ids.close()
+
+		print("Queued %d broken and %d unrecorded objects to be downloaded again" % (len(broken), len(unrecorded)))
+
+	manifest.close()
+
+	print("Checked %d objects, %d broken, %d unrecorded" % (total, len(broken), len(unrecorded)))
+
+# * Processes in the pool import this file, only the first one should run main
+if __name__ == "__main__":
+	main()
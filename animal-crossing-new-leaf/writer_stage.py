@@ -0,0 +1,63 @@
+import anyio
+import contextlib
+from metrics import metrics
+
+metrics.histogram("writer_job_seconds", "Time taken by each compression or disk write job")
+metrics.counter("writer_errors_total", "Compression or disk write jobs which failed")
+
+class WriteJob:
+	def __init__(self, func, args):
+		self.func = func
+		self.args = args
+		self.done = anyio.Event()
+		self.result = None
+		self.error = None
+
+# * Runs compression and disk writes on a pool of worker threads, so the event
+# * loop driving the NEX connection is never blocked by disk. gzip and zlib
+# * release the GIL while compressing, so compression runs on several cores.
+# * The queue is bounded, so producers wait when the writers fall behind
+class WriterStage:
+	def __init__(self, workers: int, queue_size: int):
+		self.workers = workers
+		self.limiter = anyio.CapacityLimiter(workers)
+		self.send_stream, self.receive_stream = anyio.create_memory_object_stream(queue_size)
+
+	async def work(self):
+		async for job in self.receive_stream:
+			try:
+				with metrics.time("writer_job_seconds"):
+					job.result = await anyio.to_thread.run_sync(job.func, *job.args, limiter=self.limiter)
+			except Exception as e:
+				metrics.inc("writer_errors_total", error=type(e).__name__)
+				job.error = e
+
+			job.done.set()
+
+	async def write(self, func, *args):
+		# * Waits for a free spot in the queue, then for the job to finish
+		job = WriteJob(func, args)
+
+		await self.send_stream.send(job)
+		await job.done.wait()
+
+		if job.error is not None:
+			raise job.error
+
+		return job.result
+
+@contextlib.asynccontextmanager
+async def start_writer_stage(workers: int, queue_size: int):
+	writer_stage = WriterStage(workers, queue_size)
+
+	metrics.gauge("writer_queue_depth", "Writes waiting for a writer thread", lambda: writer_stage.send_stream.statistics().current_buffer_used)
+
+	async with anyio.create_task_group() as tg:
+		for i in range(workers):
+			tg.start_soon(writer_stage.work)
+
+		try:
+			yield writer_stage
+		finally:
+			# * Lets the workers finish whatever is still queued, then exit
+			writer_stage.send_stream.close()
@@ -16,6 +16,7 @@ import base64
 from dotenv import load_dotenv
 from nintendo.nex import backend, ranking, settings
 from anynet import http
+from metrics import metrics, start_metrics_exporter
 
 load_dotenv()
 
@@ -24,9 +25,15 @@ NEX_USERNAME = os.getenv('NEX_3DS_USERNAME')
 NEX_PASSWORD = os.getenv('NEX_3DS_PASSWORD')
 NEX_VERSION = 30901 # * 3.9.1
 ACCESS_KEY = "a2dbfa39"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # * Serve metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 to turn off
+METRICS_FILE = os.getenv("METRICS_FILE", "") # * Write metrics to this file every METRICS_INTERVAL seconds, empty to turn off
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
 
 ranking_client = None
 
+metrics.histogram("nex_rpc_seconds", "Time taken by each NEX request, by method")
+metrics.counter("ms_ranking_entries_total", "Leaderboard entries downloaded")
+
 '''
 NintendoClients does not implement this properly
 '''
@@ -64,7 +71,8 @@ async def main():
 		async with be.login(NEX_USERNAME, NEX_PASSWORD) as client:
 			ranking_client = ranking.RankingClient(client)
 
-			await scrape()
+			async with start_metrics_exporter(metrics, METRICS_PORT, METRICS_FILE, METRICS_INTERVAL):
+				await scrape()
 
 async def scrape():
 	# * Ordered as they appear in-game
@@ -109,7 +117,8 @@ async def scrape():
 		order_param.offset = 0
 		order_param.count = 1
 
-		result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+		with metrics.time("nex_rpc_seconds", method="get_ranking"):
+			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
 
 		offset = 0
 		total = result.total
@@ -138,7 +147,9 @@ async def scrape():
 			order_param.count = 0xFF # * Max we can do in one go
 			order_param.order_calc = 1 # * Ordinal (1234) rankings. Prevents duplicate ranking positions (no ties)
 
-			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			with metrics.time("nex_rpc_seconds", method="get_ranking"):
+				result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+
 			rankings = result.data
 
 			for entry in rankings:
@@ -159,6 +170,7 @@ async def scrape():
 					continue
 
 				leaderboard.append(ranking_entry)
+				metrics.inc("ms_ranking_entries_total")
 				principal_id = entry.pid
 				offset += 1
 				remaining -= 1
@@ -170,6 +182,10 @@ async def scrape():
 		await write_to_file("./data/{0}/rankings.json.gz".format(category), leaderboard_data.encode("utf-8"))
 
 async def write_to_file(path, data):
+	# * Compress and write in a worker thread, so the NEX connection is not blocked by gzip
+	await anyio.to_thread.run_sync(write_compressed_file, path, data)
+
+def write_compressed_file(path, data):
 	with gzip.open(path, "w", compresslevel=9) as f:
 		f.write(data)
 
@@ -10,6 +10,7 @@ Requires Python 3 and https://github.com/Kinnay/NintendoClients
 
 from nintendo.nex import backend, ranking, settings
 from nintendo import nnas
+from metrics import metrics, start_metrics_exporter
 import anyio
 import os
 import json
@@ -34,12 +35,19 @@ LANGUAGE = config["LANGUAGE"]
 USERNAME = config["USERNAME"] # * Nintendo Network ID username
 PASSWORD = config["PASSWORD"] # * Nintendo Network ID password
 
+METRICS_PORT = config.get("METRICS_PORT", 0) # * Serve metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 to turn off
+METRICS_FILE = config.get("METRICS_FILE", "") # * Write metrics to this file every METRICS_INTERVAL seconds, empty to turn off
+METRICS_INTERVAL = config.get("METRICS_INTERVAL", 15)
+
 '''
 Globals, set later
 '''
 nex_token = None
 ranking_client = None
 
+metrics.histogram("nex_rpc_seconds", "Time taken by each NEX request, by method")
+metrics.counter("ms_ranking_entries_total", "Leaderboard entries downloaded")
+
 TITLE_ID_US = 0x00050000101E5300
 TITLE_VERSION_US = 0x10
 GAME_SERVER_ID = 0x10190300
@@ -73,8 +81,9 @@ ranking.RankingRankData.max_version = new_RankingRankData_max_version
 async def main():
 	os.makedirs("./data", exist_ok=True)
 
-	await nas_login() # * login with NNID
-	await backend_setup() # * setup the backend NEX client and start scraping
+	async with start_metrics_exporter(metrics, METRICS_PORT, METRICS_FILE, METRICS_INTERVAL):
+		await nas_login() # * login with NNID
+		await backend_setup() # * setup the backend NEX client and start scraping
 
 async def nas_login():
 	global nex_token
@@ -265,7 +274,8 @@ async def scrape():
 		order_param.offset = 0
 		order_param.count = 1
 
-		result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+		with metrics.time("nex_rpc_seconds", method="get_ranking"):
+			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
 
 		offset = 0
 		total = result.total
@@ -295,7 +305,9 @@ async def scrape():
 			order_param.count = 0xFF # * Max we can do in one go
 			order_param.order_calc = 1 # * Ordinal (1234) rankings. Prevents duplicate ranking positions (no ties)
 
-			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			with metrics.time("nex_rpc_seconds", method="get_ranking"):
+				result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+
 			rankings = result.data
 
 			for user in rankings:
@@ -435,6 +447,7 @@ async def scrape():
 				}
 
 				leaderboard.append(user_data)
+				metrics.inc("ms_ranking_entries_total")
 				principal_id = user.pid
 				offset += 1
 				remaining -= 1
@@ -446,6 +459,10 @@ async def scrape():
 		await write_to_file("./data/{0}/rankings.json.gz".format(category), leaderboard_data.encode("utf-8"))
 
 async def write_to_file(path, data):
+	# * Compress and write in a worker thread, so the NEX connection is not blocked by gzip
+	await anyio.to_thread.run_sync(write_compressed_file, path, data)
+
+def write_compressed_file(path, data):
 	with gzip.open(path, "w", compresslevel=9) as f:       # * 4. fewer bytes (i.e. gzip)
 		f.write(data)
 
@@ -10,7 +10,8 @@ Requires Python 3 and https://github.com/Kinnay/NintendoClients
 
 from nintendo.nex import backend, ranking, datastore, settings
 from nintendo import nnas
-from anynet import http
+from s3_download import create_connection_pool, download_object
+from metrics import metrics, start_metrics_exporter
 import anyio
 import os
 import json
@@ -35,12 +36,20 @@ LANGUAGE = config["LANGUAGE"]
 USERNAME = config["USERNAME"] # * Nintendo Network ID username
 PASSWORD = config["PASSWORD"] # * Nintendo Network ID password
 
+METRICS_PORT = config.get("METRICS_PORT", 0) # * Serve metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 to turn off
+METRICS_FILE = config.get("METRICS_FILE", "") # * Write metrics to this file every METRICS_INTERVAL seconds, empty to turn off
+METRICS_INTERVAL = config.get("METRICS_INTERVAL", 15)
+
 '''
 Globals, set later
 '''
 nex_token = None
 ranking_client = None
 datastore_client = None
+s3_pool = None
+
+metrics.histogram("nex_rpc_seconds", "Time taken by each NEX request, by method")
+metrics.counter("ms_ranking_entries_total", "Leaderboard entries downloaded")
 
 TITLE_ID_US = 0x0005000010106900
 TITLE_VERSION_US = 0x20
@@ -54,8 +63,9 @@ async def main():
 	os.makedirs("./data/objects", exist_ok=True) # * Stores "best run" DataStore objects
 	os.makedirs("./data/meta_binaries", exist_ok=True) # * Stores the meta binary for DataStore objects
 
-	await nas_login() # * login with NNID
-	await backend_setup() # * setup the backend NEX client and start scraping
+	async with start_metrics_exporter(metrics, METRICS_PORT, METRICS_FILE, METRICS_INTERVAL):
+		await nas_login() # * login with NNID
+		await backend_setup() # * setup the backend NEX client and start scraping
 
 async def nas_login():
 	global nex_token
@@ -71,6 +81,7 @@ async def nas_login():
 async def backend_setup():
 	global ranking_client
 	global datastore_client
+	global s3_pool
 
 	s = settings.default()
 	s.configure(ACCESS_KEY, NEX_VERSION)
@@ -80,7 +91,11 @@ async def backend_setup():
 			ranking_client = ranking.RankingClient(client)
 			datastore_client = datastore.DataStoreClient(client)
 
-			await scrape() # * start ripping courses
+			# * Keep S3 connections open between "best run" downloads
+			async with create_connection_pool(4, 4, 30) as pool:
+				s3_pool = pool
+
+				await scrape() # * start ripping courses
 
 async def scrape():
 	events = {
@@ -224,7 +239,8 @@ async def scrape():
 		order_param.offset = 0
 		order_param.count = 1
 
-		result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+		with metrics.time("nex_rpc_seconds", method="get_ranking"):
+			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
 
 		offset = 0
 		total = result.total
@@ -253,7 +269,9 @@ async def scrape():
 			order_param.count = 0xFF # * Max we can do in one go
 			order_param.order_calc = 1 # * Ordinal (1234) rankings. Prevents duplicate ranking positions (no ties)
 
-			result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+			with metrics.time("nex_rpc_seconds", method="get_ranking"):
+				result = await ranking_client.get_ranking(mode, category, order_param, unique_id, principal_id)
+
 			rankings = result.data
 
 			for user in rankings:
@@ -287,7 +305,8 @@ async def scrape():
 				param.persistence_target.persistence_id = 14
 				param.result_option = 4
 
-				result = await datastore_client.get_meta(param)
+				with metrics.time("nex_rpc_seconds", method="get_meta"):
+					result = await datastore_client.get_meta(param)
 
 				if len(result.meta_binary) != 0:
 					await write_to_file("./data/meta_binaries/{0}.bin.gz".format(result.data_id), result.meta_binary)
@@ -328,7 +347,8 @@ async def scrape():
 					param = datastore.DataStoreGetMetaParam()
 					param.data_id = user.param
 
-					result = await datastore_client.get_meta(param)
+					with metrics.time("nex_rpc_seconds", method="get_meta"):
+						result = await datastore_client.get_meta(param)
 
 					user_data["best_run"]["created"] = result.create_time.standard_datetime().isoformat();
 					user_data["best_run"]["updated"] = result.update_time.standard_datetime().isoformat();
@@ -339,16 +359,17 @@ async def scrape():
 					param = datastore.DataStorePrepareGetParam()
 					param.data_id = user.param
 
-					result = await datastore_client.prepare_get_object(param)
+					with metrics.time("nex_rpc_seconds", method="prepare_get_object"):
+						result = await datastore_client.prepare_get_object(param)
 
 					headers = {header.key: header.value for header in result.headers}
 					url = result.url
 
-					response = await http.get(url, headers=headers)
-
-					await write_to_file("./data/objects/{0}.bin.gz".format(user.param), response.body)
+					# * Stream the object straight into it's compressed file, rather than holding it all in memory
+					await download_object(url, headers, "./data/objects/{0}.bin.gz".format(user.param), result.size, pool=s3_pool, opener=open_compressed_file)
 
 				leaderboard.append(user_data)
+				metrics.inc("ms_ranking_entries_total")
 				principal_id = user.pid
 				offset += 1
 				remaining -= 1
@@ -359,6 +380,13 @@ async def scrape():
 		await write_to_file("./data/rankings/{0}.json.gz".format(category), leaderboard_data.encode("utf-8"))
 
 async def write_to_file(path, data):
+	# * Compress and write in a worker thread, so the NEX connection is not blocked by gzip
+	await anyio.to_thread.run_sync(write_compressed_file, path, data)
+
+def open_compressed_file(path, mode):
+	return gzip.open(path, mode, compresslevel=9)
+
+def write_compressed_file(path, data):
 	with gzip.open(path, "w", compresslevel=9) as f:
 		f.write(data)
 
@@ -2,156 +2,36 @@ import os
 import json
 import gzip
 import anyio
+import contextlib
 from dotenv import load_dotenv
-from nintendo.nex import common, rmc, backend, datastore_smm, settings, streams
-from anynet import http
+from nintendo.nex import common, datastore_smm, settings
+from search_window import SearchWindowDensity, SearchWindowSizer
+from probe_planner import ProbePlanner
+from manifest import Manifest
+from metadata_store import MetadataStore
+from segment_store import SegmentStore
+from blob_store import BlobStore
+from writer_stage import start_writer_stage
+from s3_download import ByteBudget, create_connection_pool, download_object
+from session_pool import start_session_pool, TRANSIENT_RMC_ERRORS
+from journal import Journal
+from pipeline import PipelineStage, start_pipeline
+from metrics import metrics, start_metrics_exporter
+from datastore_smm_extra import DataStoreGetCustomRankingByDataIdParam, BufferQueueParam, DataStoreGetCourseRecordParam, get_custom_ranking_by_data_id, get_buffer_queue, get_course_record
 
 load_dotenv()
 
-"""
-	Beginning of everything not implemented in NintendoClients
-"""
-
-class DataStoreGetCustomRankingByDataIdParam(common.Structure):
-	def __init__(self):
-		super().__init__()
-		self.application_id = None
-		self.data_id_list = None
-		self.result_option = None
-	
-	def load(self, stream: streams.StreamIn, version: int):
-		self.application_id = stream.u32()
-		self.data_id_list = stream.list(stream.u64)
-		self.result_option = stream.u8()
-	
-	def save(self, stream: streams.StreamIn, version: int):
-		stream.u32(self.application_id)
-		stream.list(self.data_id_list, stream.u64)
-		stream.u8(self.result_option)
-
-class DataStoreCustomRankingResult(common.Structure):
-	def __init__(self):
-		super().__init__()
-		self.order = None
-		self.score = None
-		self.meta_info = None
-	
-	def load(self, stream: streams.StreamIn, version: int):
-		self.order = stream.u32()
-		self.score = stream.u32()
-		self.meta_info = stream.extract(datastore_smm.DataStoreMetaInfo)
-	
-	def save(self, stream: streams.StreamIn, version: int):
-		stream.u32(self.order)
-		stream.u32(self.score)
-		stream.add(self.meta_info)
-
-class BufferQueueParam(common.Structure):
-	def __init__(self):
-		super().__init__()
-		self.data_id = None
-		self.slot = None
-	
-	def load(self, stream: streams.StreamIn, version: int):
-		self.data_id = stream.u64()
-		self.slot = stream.u32()
-	
-	def save(self, stream: streams.StreamIn, version: int):
-		stream.u64(self.data_id)
-		stream.u32(self.slot)
-
-class DataStoreGetCourseRecordParam(common.Structure):
-	def __init__(self):
-		super().__init__()
-		self.data_id = None
-		self.slot = None
-	
-	def load(self, stream: streams.StreamIn, version: int):
-		self.data_id = stream.u64()
-		self.slot = stream.u8()
-	
-	def save(self, stream: streams.StreamIn, version: int):
-		stream.u64(self.data_id)
-		stream.u8(self.slot)
-
-class DataStoreGetCourseRecordResult(common.Structure):
-	def __init__(self):
-		super().__init__()
-		self.data_id = None
-		self.slot = None
-		self.first_pid = None
-		self.best_pid = None
-		self.best_score = None
-		self.created_time = None
-		self.updated_time = None
-	
-	def load(self, stream: streams.StreamIn, version: int):
-		self.data_id = stream.u64()
-		self.slot = stream.u8()
-		self.first_pid = stream.u32()
-		self.best_pid = stream.u32()
-		self.best_score = stream.s32()
-		self.created_time = stream.datetime()
-		self.updated_time = stream.datetime()
-	
-	def save(self, stream: streams.StreamIn, version: int):
-		stream.u64(self.data_id)
-		stream.u8(self.slot)
-		stream.u32(self.first_pid)
-		stream.u32(self.best_pid)
-		stream.s32(self.best_score)
-		stream.datetime(self.created_time)
-		stream.datetime(self.updated_time)
-
-async def get_custom_ranking_by_data_id(param: DataStoreGetCustomRankingByDataIdParam) -> rmc.RMCResponse:
-	# * --- request ---
-	stream = streams.StreamOut(datastore_smm_client.settings)
-	stream.add(param)
-	data = await datastore_smm_client.client.request(datastore_smm_client.PROTOCOL_ID, 50, stream.get())
-
-	# * --- response ---
-	stream = streams.StreamIn(data, datastore_smm_client.settings)
-
-	obj = rmc.RMCResponse()
-	obj.ranking_result = stream.list(DataStoreCustomRankingResult)
-	obj.results = stream.list(common.Result)
-
-	return obj
-
-async def get_buffer_queue(param: BufferQueueParam) -> list[bytes]:
-	# * --- request ---
-	stream = streams.StreamOut(datastore_smm_client.settings)
-	stream.add(param)
-	data = await datastore_smm_client.client.request(datastore_smm_client.PROTOCOL_ID, 54, stream.get())
-
-	# * --- response ---
-	stream = streams.StreamIn(data, datastore_smm_client.settings)
-
-	result = stream.list(stream.qbuffer)
-
-	return result
-
-async def get_course_record(param: DataStoreGetCourseRecordParam) -> DataStoreGetCourseRecordResult:
-	# * --- request ---
-	stream = streams.StreamOut(datastore_smm_client.settings)
-	stream.add(param)
-	data = await datastore_smm_client.client.request(datastore_smm_client.PROTOCOL_ID, 72, stream.get())
-
-	# * --- response ---
-	stream = streams.StreamIn(data, datastore_smm_client.settings)
-
-	result = stream.extract(DataStoreGetCourseRecordResult)
-
-	return result
-
-"""
-	End of everything not implemented in NintendoClients
-"""
-
 # * Dump using https://github.com/Stary2001/nex-dissector/tree/master/get_3ds_pid_password or from network dumps
 NEX_USERNAME = os.getenv('NEX_USERNAME')
 NEX_PASSWORD = os.getenv('NEX_PASSWORD')
-datastore_smm_client = None # * Gets set later
+NEX_HOST = os.getenv('NEX_HOST', '52.40.192.64') # * Skips the NNID API. Point at fake_server.py to benchmark offline
+NEX_PORT = int(os.getenv('NEX_PORT', '59900'))
+NEX_SESSIONS_PER_ACCOUNT = int(os.getenv('NEX_SESSIONS_PER_ACCOUNT', '1')) # * Sessions logged in at once for each account
+session_pool = None # * Gets set later
+writer_stage = None # * Gets set later
+download_budget = None # * Gets set later
+s3_pool = None # * Gets set later
+pipeline = None # * Gets set later
 
 KNOWN_BUFFER_QUEUE_SLOTS = [ 0, 2, 3 ]
 
@@ -171,156 +51,367 @@ KNOWN_CUSTOM_RANKING_APPLICATION_IDS = [
 
 KNOWN_COURSE_RECORD_SLOTS = [ 0 ]
 
-if os.path.isfile('last-checked-timestamp.txt') and os.access('last-checked-timestamp.txt', os.R_OK):
-	last_checked_timestamp_file = open('last-checked-timestamp.txt', 'r+')
-	last_checked_timestamp = int(last_checked_timestamp_file.read())
-else:
-	last_checked_timestamp_file = open('last-checked-timestamp.txt', 'x+')
-	last_checked_timestamp_file.write("135271087238")
-	last_checked_timestamp = 135271087238 # * 4-11-2015 15:50:06, date of first objects upload
+# * Every object has one of each of these written next to it
+SIDECARS = [ 'metadata', 'custom-rankings', 'buffer-queues', 'course-records' ]
+
+CUSTOM_RANKING_BATCH_SIZE = 100 # * Number of data IDs sent in each custom ranking request
+
+# * "files" writes every object and sidecar to it's own file, "segments" appends them to large segment files
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'files')
+SEGMENT_SIZE = int(os.getenv('SEGMENT_SIZE', str(1024 * 1024 * 1024))) # * Start a new segment once the current one reaches 1GiB
+DEDUP_OBJECTS = os.getenv('DEDUP_OBJECTS', '1') == '1' # * Store identical object data once, keyed by it's SHA-256
+
+WRITER_THREADS = int(os.getenv('WRITER_THREADS', str(os.cpu_count() or 4))) # * Threads used to compress and write files
+WRITER_QUEUE_SIZE = int(os.getenv('WRITER_QUEUE_SIZE', '256')) # * Writes which can wait for a thread before archiving is paused
 
-os.makedirs('./objects', exist_ok=True)
-os.makedirs('./metadata', exist_ok=True)
-os.makedirs('./custom-rankings', exist_ok=True)
-os.makedirs('./buffer-queues', exist_ok=True)
-os.makedirs('./course-records', exist_ok=True)
+MAX_DOWNLOAD_BYTES_IN_FLIGHT = int(os.getenv('MAX_DOWNLOAD_BYTES_IN_FLIGHT', str(256 * 1024 * 1024))) # * New downloads wait once this many bytes are downloading
+
+S3_MAX_CONNECTIONS = int(os.getenv('S3_MAX_CONNECTIONS', '64')) # * Connections to S3 kept open at once
+S3_MAX_CONNECTIONS_PER_HOST = int(os.getenv('S3_MAX_CONNECTIONS_PER_HOST', '32'))
+S3_IDLE_TIMEOUT = float(os.getenv('S3_IDLE_TIMEOUT', '30')) # * Seconds before an unused connection is closed
+
+# * Objects go through PrepareGetObject, then probes, then the S3 download, then
+# * writing, with this many objects in each stage at once
+PREPARE_WORKERS = int(os.getenv('PREPARE_WORKERS', '64'))
+PROBE_WORKERS = int(os.getenv('PROBE_WORKERS', '64'))
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '32'))
+WRITE_WORKERS = int(os.getenv('WRITE_WORKERS', '64'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '100')) # * Objects which can wait for each stage
+PIPELINE_WINDOWS_AHEAD = int(os.getenv('PIPELINE_WINDOWS_AHEAD', '4')) # * Windows each shard can search ahead of the oldest unfinished one
+
+# * Skip probes which have never succeeded for an objects data_type
+PROBE_PRUNING = os.getenv('PROBE_PRUNING', '1') == '1'
+PROBE_AUDIT_RATE = float(os.getenv('PROBE_AUDIT_RATE', '0.01')) # * Chance of sending a probe which would be skipped anyway
+
+# * Splits the timeline into this many shards which are scanned at the same time
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+
+FIRST_UPLOAD_TIMESTAMP = 135271087238 # * 4-11-2015 15:50:06, date of first objects upload
+MAX_TIMESTAMP = common.DateTime.make(2024, 4, 1).value() # * Stop searching after April 1st, 2024 (official shut down)
+SEARCH_WINDOW_SECONDS = 43200 # * Grab objects in 12 hour chunks, unless the window is resized
+
+# * "timeline" walks every object by upload date. "updates" walks objects by the time they were
+# * last updated, starting where the last "updates" run stopped, and skips any whose update time
+# * and ratings already match metadata.db. "ids" checks every data ID between the oldest and
+# * newest object, which also finds objects searches do not return
+CRAWL_MODE = os.getenv('CRAWL_MODE', 'timeline')
+ID_BATCH_SIZE = 100 # * Data IDs checked by each step of a sweep
+META_LOOKUPS_PER_REQUEST = 30 # * Data IDs sent in each GetMetasMultipleParam request, see get_metas
+ADAPTIVE_SEARCH_WINDOW = os.getenv('ADAPTIVE_SEARCH_WINDOW', '1') == '1'
+SEARCH_PAGE_SIZE = 100 # * Throws DataStore::InvalidArgument for anything higher than 100
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # * Serve metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 to turn off
+METRICS_FILE = os.getenv('METRICS_FILE', '') # * Write metrics to this file every METRICS_INTERVAL seconds, empty to turn off
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', '15'))
+
+JOURNAL_CHECKPOINT_WINDOWS = 10 # * Fold the journal into the manifest and checkpoint files after this many windows
+
+def read_checkpoint(path: str, default: int) -> int:
+	if os.path.isfile(path) and os.access(path, os.R_OK):
+		with open(path, 'r') as checkpoint_file:
+			return int(checkpoint_file.read())
+
+	write_checkpoint(path, default)
+
+	return default
+
+def write_checkpoint(path: str, timestamp: int):
+	# * Write to a temp file first so a crash never leaves a half written checkpoint
+	temp_path = path + '.tmp'
+
+	with open(temp_path, 'w') as checkpoint_file:
+		checkpoint_file.write(str(timestamp))
+		checkpoint_file.flush()
+		os.fsync(checkpoint_file.fileno())
+
+	os.replace(temp_path, path)
+
+def manifest_row(record: dict) -> tuple[int, int, int, str, list[str]]:
+	return (record['data_id'], record['version'], record['size'], record['checksum'], record['sidecars'])
+
+def compact_journal():
+	# * Everything in the journal is made durable in the manifest and checkpoint
+	# * files, then the journal is emptied. Appends run on writer threads, so one
+	# * can land before or after the reset. That is safe, as an object is always
+	# * recorded in the manifest before it's append is queued, so the commit
+	# * below already covers anything the reset throws away
+	if segment_store is not None:
+		# * Other windows may still be writing, and the manifest must never
+		# * point at segment data which is not on disk yet
+		segment_store.commit()
+
+	manifest.commit()
+	metadata_store.commit()
+
+	for path, timestamp in journal_windows.items():
+		write_checkpoint(path, timestamp)
+
+	journal.reset()
+
+def replay_journal():
+	records = journal.replay()
+	rows = []
+
+	for record in records:
+		if record['type'] == 'object':
+			rows.append(manifest_row(record))
+		elif record['type'] == 'window':
+			rows += [manifest_row(obj) for obj in record['objects']]
+			journal_windows[record['checkpoint']] = record['timestamp']
+
+	manifest.record_many(rows)
+	compact_journal()
+
+	if records:
+		print("Recovered %d objects and %d windows from the journal" % (len(rows), len(journal_windows)))
+
+manifest = Manifest('manifest.db')
+metadata_store = MetadataStore('metadata.db')
+journal = Journal('crawl-journal.log')
+journal_windows = {} # * Checkpoint file -> timestamp the shard should resume from
+pipeline_data_ids = set() # * Objects found but not yet finished
+
+if OUTPUT_FORMAT == 'segments':
+	segment_store = SegmentStore('./segments', SEGMENT_SIZE)
+	blob_store = None # * Segments dedup objects themselves
+
+	os.makedirs('./segments/incoming', exist_ok=True)
+else:
+	segment_store = None
+	blob_store = BlobStore('./blobs') if DEDUP_OBJECTS else None
+
+	os.makedirs('./objects', exist_ok=True)
+	os.makedirs('./metadata', exist_ok=True)
+	os.makedirs('./custom-rankings', exist_ok=True)
+	os.makedirs('./buffer-queues', exist_ok=True)
+	os.makedirs('./course-records', exist_ok=True)
+
+# * Must happen before any checkpoint is read
+replay_journal()
+
+if segment_store is not None:
+	# * Downloads which had not been copied into a segment when the last run
+	# * stopped. Nothing points at them, so they are downloaded again when found
+	for entry in os.scandir('./segments/incoming'):
+		if entry.is_file():
+			os.remove(entry.path)
+else:
+	# * Downloads, and links to stored blobs, which were cut off when the last
+	# * run stopped. The objects are downloaded again when found
+	for entry in os.scandir('./objects'):
+		if entry.is_file() and entry.name.endswith(('.part', '.link')):
+			os.remove(entry.path)
+
+last_checked_timestamp = read_checkpoint('last-checked-timestamp.txt', FIRST_UPLOAD_TIMESTAMP)
+search_window_density = SearchWindowDensity('update-window-density.json' if CRAWL_MODE == 'updates' else 'search-window-density.json')
+probe_planner = ProbePlanner('probe-stats.json', PROBE_PRUNING, PROBE_AUDIT_RATE)
+
+metrics.counter('archive_objects_total', 'Objects seen, by if they were downloaded, refreshed, skipped or failed')
+metrics.counter('archive_errors_total', 'Errors which were ignored, by where they happened')
+metrics.counter('smm_windows_total', 'Search windows finished')
+metrics.counter('smm_search_objects_total', 'Objects returned by searches')
+metrics.counter('smm_search_duplicates_total', 'Objects returned again at the start of the next window, which were dropped')
+metrics.gauge('s3_bytes_in_flight', 'Object bytes reserved by downloads in progress', lambda: download_budget.in_flight if download_budget is not None else 0)
 
 def should_download_object(data_id: int, expected_object_size: int, expected_object_version: int) -> bool:
-	object_path = './objects/%d_v%d.bin' % (data_id, expected_object_version)
-	metadata_path = './metadata/%d_v%d.json.gz' % (data_id, expected_object_version)
-	custom_rankings_path = './custom-rankings/%d_v%d.json.gz' % (data_id, expected_object_version)
-	buffer_queues_path = './buffer-queues/%d_v%d.json.gz' % (data_id, expected_object_version)
-	course_records_path = './course-records/%d_v%d.json.gz' % (data_id, expected_object_version)
+	# * Only objects which had every file written are in the manifest
+	return not manifest.is_complete(data_id, expected_object_version, expected_object_size, SIDECARS)
 
-	if not os.path.exists(object_path):
-		return True
+def is_archived(obj: datastore_smm.DataStoreMetaInfo) -> bool:
+	# * Decided from the search result alone, so objects which are already
+	# * archived cost no requests. The version is only known from the S3 URL,
+	# * so it's taken from metadata.db, which is only trusted while the
+	# * objects update time and size have not changed since it was recorded
+	last_seen = metadata_store.last_seen(obj.data_id)
 
-	if not os.path.exists(metadata_path):
-		return True
+	if last_seen is None:
+		return False
 
-	if not os.path.exists(custom_rankings_path):
-		return True
+	version, size, update_time, ratings = last_seen
 
-	if not os.path.exists(buffer_queues_path):
-		return True
+	if update_time != obj.update_time.value() or size != obj.size:
+		return False
 
-	if not os.path.exists(course_records_path):
-		return True
+	return manifest.is_complete(obj.data_id, version, None, SIDECARS)
 
-	if os.path.getsize(object_path) != expected_object_size:
-		return True
-
-	return False # * If nothing bails early, assume the object does not need to be redownloaded
+async def download_object_buffer_queues(buffer_queues: list[dict], data_id: int, data_type: int, slot: int):
+	probe = 'buffer-queue-%d' % slot
 
-async def download_object_buffer_queues(buffer_queues: list[dict], data_id: int, slot: int):
 	try:
 		param = BufferQueueParam()
 		param.data_id = data_id
 		param.slot = slot
 
-		response = await get_buffer_queue(param)
+		response = await session_pool.call(get_buffer_queue, param)
+	except common.RMCError as e:
+		if e.name() in TRANSIENT_RMC_ERRORS:
+			# * The server failed rather than saying the slot is empty. The
+			# * object fails, and the slot is probed again on the next run
+			raise
 
-		buffer_queues.append({
-			"slot": slot,
-			"buffers": [buffer.hex() for buffer in response]
-		})
+		# * SMM will throw errors if an object has no buffers in the slot
+		probe_planner.record(data_type, probe, False)
+		return
 	except:
 		# * Eat errors
-		# * SMM will throw errors if an object has no buffers in the slot
+		# * Anything other than an RMC error says nothing about the slot, so it is not recorded
+		metrics.inc('archive_errors_total', stage=probe)
 		return
 
-async def download_object_custom_ranking(custom_rankings: list[dict], data_id: int, application_id: int):
+	probe_planner.record(data_type, probe, True)
+
+	buffer_queues.append({
+		"slot": slot,
+		"buffers": [buffer.hex() for buffer in response]
+	})
+
+async def download_object_custom_ranking(custom_rankings: list[dict], failed_data_ids: set[int], data_id: int, data_type: int, application_id: int):
+	probe = 'custom-ranking-%d' % application_id
+
 	try:
 		param = DataStoreGetCustomRankingByDataIdParam()
 		param.application_id = application_id
 		param.data_id_list = [data_id]
 		param.result_option = 0
 
-		response = await get_custom_ranking_by_data_id(param)
+		response = await session_pool.call(get_custom_ranking_by_data_id, param)
+	except common.RMCError as e:
+		if e.name() in TRANSIENT_RMC_ERRORS:
+			# * The server failed rather than saying there is no ranking. This
+			# * runs before the object is in the pipeline, so queue_window fails it
+			failed_data_ids.add(data_id)
+			return
 
-		custom_rankings.append({
-			"application_id": application_id,
-			"score": response.ranking_result[0].score
-		})
-	except:
-		# * Eat errors
 		# * SMM will throw errors if an object has no ranking in the application ID
+		probe_planner.record(data_type, probe, False)
 		return
-
-async def download_course_record(course_records: list[dict], data_id: int, slot: int):
-	# * This is expected to fail OFTEN
-	# * Only course objects have records
-	try:
-		param = DataStoreGetCourseRecordParam()
-		param.data_id = data_id
-		param.slot = slot
-
-		response = await get_course_record(param)
-
-		course_records.append({
-			"slot": response.slot,
-			"first_pid": response.first_pid,
-			"best_pid": response.best_pid,
-			"best_score": response.best_score,
-			"created_time": {
-				'original_value': response.created_time.value(),
-				'standard': response.created_time.standard_datetime().strftime("%Y-%m-%d %H:%M:%S")
-			},
-			"updated_time": {
-				'original_value': response.updated_time.value(),
-				'standard': response.updated_time.standard_datetime().strftime("%Y-%m-%d %H:%M:%S")
-			}
-		})
 	except:
 		# * Eat errors
-		# * SMM will throw errors if an object has no record in the slot
+		metrics.inc('archive_errors_total', stage=probe)
 		return
 
-async def write_compressed_json(path: str, data: dict):
-	with gzip.open(path, 'wb', compresslevel=6) as metadata_file:
-		metadata_file.write(json.dumps(data).encode('utf-8'))
+	probe_planner.record(data_type, probe, True)
 
-async def process_datastore_object(obj: datastore_smm.DataStoreMetaInfo):
-	param = datastore_smm.DataStorePrepareGetParam()
-	param.data_id = obj.data_id
+	custom_rankings.append({
+		"application_id": application_id,
+		"score": response.ranking_result[0].score
+	})
 
-	get_object_response = await datastore_smm_client.prepare_get_object(param)
+async def download_custom_rankings_batch(custom_rankings: dict[int, list[dict]], failed_data_ids: set[int], data_types: dict[int, int], data_ids: list[int], application_id: int):
+	probe = 'custom-ranking-%d' % application_id
 
-	s3_headers = {header.key: header.value for header in get_object_response.headers}
-	s3_url = get_object_response.url
-	data_id = get_object_response.data_id
-	object_version = int(s3_url.split('/')[-1].split('-')[1].split('?')[0])
+	try:
+		param = DataStoreGetCustomRankingByDataIdParam()
+		param.application_id = application_id
+		param.data_id_list = data_ids
+		param.result_option = 0
+
+		response = await session_pool.call(get_custom_ranking_by_data_id, param)
+	except:
+		# * SMM throws an error rather than an empty list when no object in the
+		# * batch has a ranking in the application ID, but the error can also be
+		# * about the request itself. Either way it says nothing certain about any
+		# * one object, so fall back to asking for each object on its own
+		async with anyio.create_task_group() as tg:
+			for data_id in data_ids:
+				tg.start_soon(download_object_custom_ranking, custom_rankings[data_id], failed_data_ids, data_id, data_types[data_id], application_id)
 
-	if not should_download_object(data_id, get_object_response.size, object_version):
-		# * Object data already downloaded
-		print("Skipping %d" % data_id)
 		return
 
-	buffer_queues = []
+	ranked_data_ids = set()
 
-	async with anyio.create_task_group() as tg:
-		for slot in KNOWN_BUFFER_QUEUE_SLOTS:
-			tg.start_soon(download_object_buffer_queues, buffer_queues, data_id, slot)
+	# * Objects with no ranking in the application ID are left out of
+	# * ranking_result, so match results back to objects by their data ID
+	for ranking_result in response.ranking_result:
+		data_id = ranking_result.meta_info.data_id
+
+		if data_id in custom_rankings:
+			ranked_data_ids.add(data_id)
+			custom_rankings[data_id].append({
+				"application_id": application_id,
+				"score": ranking_result.score
+			})
 
-	custom_rankings = []
+	for data_id in data_ids:
+		probe_planner.record(data_types[data_id], probe, data_id in ranked_data_ids)
 
+async def download_custom_rankings(objects: list[datastore_smm.DataStoreMetaInfo]) -> tuple[dict[int, list[dict]], set[int]]:
+	custom_rankings = {obj.data_id: [] for obj in objects}
+	failed_data_ids = set() # * Objects whose rankings could not be looked up
+	data_types = {obj.data_id: obj.data_type for obj in objects}
+
+	# * One request per application ID for the whole page, rather than one per object
 	async with anyio.create_task_group() as tg:
 		for application_id in KNOWN_CUSTOM_RANKING_APPLICATION_IDS:
-			tg.start_soon(download_object_custom_ranking, custom_rankings, data_id, application_id)
+			probe = 'custom-ranking-%d' % application_id
+			data_ids = [obj.data_id for obj in objects if probe_planner.should_probe(obj.data_type, probe)]
 
-	course_records = []
+			for i in range(0, len(data_ids), CUSTOM_RANKING_BATCH_SIZE):
+				tg.start_soon(download_custom_rankings_batch, custom_rankings, failed_data_ids, data_types, data_ids[i:i + CUSTOM_RANKING_BATCH_SIZE], application_id)
 
-	async with anyio.create_task_group() as tg:
-		for slot in KNOWN_COURSE_RECORD_SLOTS:
-			tg.start_soon(download_course_record, course_records, data_id, slot)
+	return custom_rankings, failed_data_ids
+
+async def download_course_record(course_records: list[dict], data_id: int, data_type: int, slot: int):
+	# * This is expected to fail OFTEN
+	# * Only course objects have records
+	probe = 'course-record-%d' % slot
+
+	try:
+		param = DataStoreGetCourseRecordParam()
+		param.data_id = data_id
+		param.slot = slot
+
+		response = await session_pool.call(get_course_record, param)
+	except common.RMCError as e:
+		if e.name() in TRANSIENT_RMC_ERRORS:
+			# * The server failed rather than saying there is no record. The
+			# * object fails, and the slot is probed again on the next run
+			raise
+
+		# * SMM will throw errors if an object has no record in the slot
+		probe_planner.record(data_type, probe, False)
+		return
+	except:
+		# * Eat errors
+		metrics.inc('archive_errors_total', stage=probe)
+		return
+
+	probe_planner.record(data_type, probe, True)
+
+	course_records.append({
+		"slot": response.slot,
+		"first_pid": response.first_pid,
+		"best_pid": response.best_pid,
+		"best_score": response.best_score,
+		"created_time": {
+			'original_value': response.created_time.value(),
+			'standard': response.created_time.standard_datetime().strftime("%Y-%m-%d %H:%M:%S")
+		},
+		"updated_time": {
+			'original_value': response.updated_time.value(),
+			'standard': response.updated_time.standard_datetime().strftime("%Y-%m-%d %H:%M:%S")
+		}
+	})
+
+def write_file(path: str, data: bytes):
+	with open(path, 'wb') as output_file:
+		output_file.write(data)
+
+def compress_json(data: dict) -> bytes:
+	return gzip.compress(json.dumps(data).encode('utf-8'), compresslevel=6)
+
+def write_compressed_json(path: str, data: dict):
+	write_file(path, compress_json(data))
 
-	s3_response = await http.get(s3_url, headers=s3_headers)
+async def write_segment_object(data_id: int, object_version: int, object_path: str, checksum: str):
+	await writer_stage.write(segment_store.append_file, data_id, object_version, 'object', object_path, checksum if DEDUP_OBJECTS else None)
+	os.remove(object_path)
 
-	object_file = open('./objects/%d_v%d.bin' % (data_id, object_version), 'wb')
-	object_file.write(s3_response.body)
-	object_file.close()
+async def write_segment_sidecar(data_id: int, object_version: int, sidecar: str, data: dict):
+	compressed = await writer_stage.write(compress_json, data)
+	await writer_stage.write(segment_store.append, data_id, object_version, sidecar, compressed)
 
-	metadata = {
+def build_metadata(obj: datastore_smm.DataStoreMetaInfo) -> dict:
+	return {
 		'data_id': obj.data_id,
 		'owner_id': obj.owner_id,
 		'size': obj.size,
@@ -370,70 +461,569 @@ async def process_datastore_object(obj: datastore_smm.DataStoreMetaInfo):
 		]
 	}
 
-	files = [
-		('./metadata/%d_v%d.json.gz' % (data_id, object_version), metadata),
-		('./custom-rankings/%d_v%d.json.gz' % (data_id, object_version), custom_rankings),
-		('./buffer-queues/%d_v%d.json.gz' % (data_id, object_version), buffer_queues),
-		('./course-records/%d_v%d.json.gz' % (data_id, object_version), course_records),
+def has_changed(obj: datastore_smm.DataStoreMetaInfo) -> bool:
+	# * Compared against the newest version of the object in metadata.db
+	last_seen = metadata_store.last_seen(obj.data_id)
+
+	if last_seen is None:
+		return True
+
+	version, size, update_time, ratings = last_seen
+
+	return update_time != obj.update_time.value() or ratings != {rating.slot: (rating.info.total_value, rating.info.count) for rating in obj.ratings}
+
+async def refresh_object_metadata(data_id: int, object_version: int, obj: datastore_smm.DataStoreMetaInfo, custom_rankings: list[dict]):
+	# * The object data is unchanged, only the metadata, ratings and custom
+	# * rankings are written again. Rankings were already looked up for the window
+	metadata = build_metadata(obj)
+	metadata_store.record(object_version, metadata)
+
+	sidecars = [
+		('metadata', metadata),
+		('custom-rankings', custom_rankings),
 	]
 
-	# * Write all files at once
 	async with anyio.create_task_group() as tg:
-		for f in files:
-			path, data = f
-			tg.start_soon(write_compressed_json, path, data)
+		for sidecar, data in sidecars:
+			if segment_store is not None:
+				tg.start_soon(write_segment_sidecar, data_id, object_version, sidecar, data)
+			else:
+				tg.start_soon(writer_stage.write, write_compressed_json, './%s/%d_v%d.json.gz' % (sidecar, data_id, object_version), data)
+
+class PipelineWindow:
+	# * The objects found by one search or batch of data IDs. The window is
+	# * only journaled once every one of them has left the pipeline, and only
+	# * if none of them failed, so the window is searched again on the next run
+	def __init__(self, checkpoint: int, object_count: int):
+		self.checkpoint = checkpoint
+		self.remaining = object_count
+		self.completed = []
+		self.failed = 0
+		self.done = anyio.Event()
+
+		if object_count == 0:
+			self.done.set()
+
+	def object_done(self, record: dict | None = None):
+		if record is not None:
+			self.completed.append(record)
+
+		self.remaining -= 1
+
+		if self.remaining == 0:
+			self.done.set()
+
+	def object_failed(self):
+		self.failed += 1
+		self.object_done()
+
+class PipelineObject:
+	def __init__(self, window: PipelineWindow, obj: datastore_smm.DataStoreMetaInfo, custom_rankings: list[dict]):
+		self.window = window
+		self.obj = obj
+		self.custom_rankings = custom_rankings
+		self.data_id = obj.data_id
+		self.object_version = 0 # * Gets set by prepare_object
+		self.size = 0
+		self.s3_url = ''
+		self.s3_headers = {}
+		self.buffer_queues = []
+		self.course_records = []
+		self.object_path = ''
+		self.checksum = ''
+
+	def done(self, record: dict | None = None):
+		pipeline_data_ids.discard(self.obj.data_id)
+		self.window.object_done(record)
+
+	def failed(self):
+		pipeline_data_ids.discard(self.obj.data_id)
+		self.window.object_failed()
+
+def object_failed(stage: PipelineStage, item: PipelineObject, e: Exception):
+	# * Requests were already retried if the error was transient. The object
+	# * is left for the next run instead of stopping the whole crawl
+	print("Failed to archive %d in the %s stage: %s" % (item.data_id, stage.name, repr(e)))
+	metrics.inc('archive_objects_total', result='failed')
+	item.failed()
+
+async def prepare_object(item: PipelineObject) -> PipelineObject | None:
+	param = datastore_smm.DataStorePrepareGetParam()
+	param.data_id = item.obj.data_id
 
-async def main():
-	s = settings.default()
-	s.configure("9f2b4678", 30810)
+	get_object_response = await session_pool.call(datastore_smm.DataStoreClientSMM.prepare_get_object, param)
+
+	item.s3_headers = {header.key: header.value for header in get_object_response.headers}
+	item.s3_url = get_object_response.url
+	item.data_id = get_object_response.data_id
+	item.size = get_object_response.size
+	item.object_version = int(item.s3_url.split('/')[-1].split('-')[1].split('?')[0])
+
+	if not should_download_object(item.data_id, item.size, item.object_version):
+		if CRAWL_MODE == 'updates':
+			# * Only found if it changed, so the metadata is out of date
+			print("Refreshing metadata of %d" % item.data_id)
+			await refresh_object_metadata(item.data_id, item.object_version, item.obj, item.custom_rankings)
+			metrics.inc('archive_objects_total', result='refreshed')
+		else:
+			# * Object data already downloaded
+			print("Skipping %d" % item.data_id)
+			metrics.inc('archive_objects_total', result='skipped')
+
+		item.done()
+		return None
+
+	return item
 
-	async with backend.connect(s, "52.40.192.64", "59900") as be: # * Skip NNID API
-		async with be.login(NEX_USERNAME, NEX_PASSWORD) as client:
-			global datastore_smm_client
-			datastore_smm_client = datastore_smm.DataStoreClientSMM(client)
+async def probe_object(item: PipelineObject) -> PipelineObject:
+	data_type = item.obj.data_type
+
+	async with anyio.create_task_group() as tg:
+		for slot in KNOWN_BUFFER_QUEUE_SLOTS:
+			if probe_planner.should_probe(data_type, 'buffer-queue-%d' % slot):
+				tg.start_soon(download_object_buffer_queues, item.buffer_queues, item.data_id, data_type, slot)
+
+		for slot in KNOWN_COURSE_RECORD_SLOTS:
+			if probe_planner.should_probe(data_type, 'course-record-%d' % slot):
+				tg.start_soon(download_course_record, item.course_records, item.data_id, data_type, slot)
 
-			current_timestamp = last_checked_timestamp
-			twelve_hours = 43200 # * Grab objects in 12 hour chunks
-			max_timestamp = common.DateTime.make(2024, 4, 1).value() # * Stop searching after April 1st, 2024 (official shut down)
-			keep_searching = True
+	return item
 
-			while keep_searching:
-				start_datetime = common.DateTime(current_timestamp)
-				end_datetime = common.DateTime.fromtimestamp(common.DateTime(current_timestamp).timestamp() + twelve_hours)
+async def fetch_object(item: PipelineObject) -> PipelineObject:
+	if segment_store is not None:
+		# * Objects are streamed to their own file first, then copied into a segment
+		item.object_path = './segments/incoming/%d_v%d.bin' % (item.data_id, item.object_version)
+	else:
+		item.object_path = './objects/%d_v%d.bin' % (item.data_id, item.object_version)
 
-				print("Downloading next 100 objects between %s to %s" % (start_datetime, end_datetime))
+	item.checksum = await download_object(item.s3_url, item.s3_headers, item.object_path, item.size, download_budget, s3_pool)
+
+	if blob_store is not None:
+		await writer_stage.write(blob_store.add, item.object_path, item.checksum)
+
+	return item
+
+async def write_object(item: PipelineObject) -> None:
+	data_id = item.data_id
+	object_version = item.object_version
+
+	metadata = build_metadata(item.obj)
+	metadata_store.record(object_version, metadata)
+
+	sidecars = [
+		('metadata', metadata),
+		('custom-rankings', item.custom_rankings),
+		('buffer-queues', item.buffer_queues),
+		('course-records', item.course_records),
+	]
+
+	# * Write all files at once. Compression and disk writes happen in the writer stage
+	async with anyio.create_task_group() as tg:
+		if segment_store is not None:
+			tg.start_soon(write_segment_object, data_id, object_version, item.object_path, item.checksum)
+
+			for sidecar, data in sidecars:
+				tg.start_soon(write_segment_sidecar, data_id, object_version, sidecar, data)
+		else:
+			for sidecar, data in sidecars:
+				tg.start_soon(writer_stage.write, write_compressed_json, './%s/%d_v%d.json.gz' % (sidecar, data_id, object_version), data)
+
+	record = {
+		'type': 'object',
+		'data_id': data_id,
+		'version': object_version,
+		'size': item.size,
+		'checksum': item.checksum,
+		'sidecars': SIDECARS
+	}
 
-				param = datastore_smm.DataStoreSearchParam()
+	manifest.record(*manifest_row(record))
+	metrics.inc('archive_objects_total', result='downloaded')
+
+	if segment_store is None:
+		# * The files are complete, so the object never has to be downloaded again.
+		# * Segments are only synced once per window, so those objects are
+		# * journaled with the window instead
+		await writer_stage.write(journal.append, record)
+
+	item.done(record)
+
+def create_pipeline_stages() -> list[PipelineStage]:
+	return [
+		PipelineStage('prepare', prepare_object, PREPARE_WORKERS),
+		PipelineStage('probe', probe_object, PROBE_WORKERS),
+		PipelineStage('fetch', fetch_object, FETCH_WORKERS),
+		PipelineStage('write', write_object, WRITE_WORKERS),
+	]
+
+async def queue_window(windows, objects: list[datastore_smm.DataStoreMetaInfo], checkpoint: int):
+	# * An object can be found again while it is still in the pipeline, for
+	# * example if it was updated while paging. It is only processed once
+	objects = [obj for obj in objects if obj.data_id not in pipeline_data_ids]
+	pipeline_data_ids.update(obj.data_id for obj in objects)
+
+	# * Custom rankings are requested for the whole window at once, before
+	# * it's objects are handed to the pipeline
+	custom_rankings, failed_data_ids = await download_custom_rankings(objects)
+	window = PipelineWindow(checkpoint, len(objects))
+
+	# * Waits if too many windows are still being processed
+	await windows.send(window)
+
+	for obj in objects:
+		item = PipelineObject(window, obj, custom_rankings[obj.data_id])
+
+		if obj.data_id in failed_data_ids:
+			# * It would be archived without some of its rankings, so it is
+			# * failed the same way as objects which fail in the pipeline
+			print("Failed to archive %d, its custom rankings could not be downloaded" % obj.data_id)
+			metrics.inc('archive_objects_total', result='failed')
+			item.failed()
+			continue
+
+		await pipeline.send(item)
+
+async def finish_windows(shard, receive_stream):
+	# * Windows are journaled in the order they were found, so a restart never skips an unfinished one
+	async with receive_stream:
+		async for window in receive_stream:
+			await window.done.wait()
+
+			if window.failed > 0 or shard.failed_objects > 0:
+				# * The checkpoint can't move past a window with a failed object, so
+				# * it and every window after it are searched again on the next run.
+				# * Objects which did finish are in the manifest and are skipped then
+				shard.failed_objects += window.failed
+				continue
+
+			await finish_window(shard, window.completed, window.checkpoint)
+
+@contextlib.asynccontextmanager
+async def start_window_finisher(shard):
+	send_stream, receive_stream = anyio.create_memory_object_stream(PIPELINE_WINDOWS_AHEAD)
+
+	async with anyio.create_task_group() as tg:
+		tg.start_soon(finish_windows, shard, receive_stream)
+
+		async with send_stream:
+			yield send_stream
+
+async def finish_window(shard, completed: list[dict], checkpoint: int):
+	# * "checkpoint" is where the shard resumes from, a timestamp or a data ID depending on CRAWL_MODE
+	if segment_store is not None:
+		# * Segments must be on disk before the journal says the objects are done
+		await writer_stage.write(segment_store.commit)
+
+	metadata_store.commit()
+
+	# * Once this record is on disk the window is done. A restart resumes from the next one
+	await writer_stage.write(journal.append, {
+		'type': 'window',
+		'checkpoint': shard.checkpoint_path,
+		'timestamp': checkpoint,
+		'objects': completed if segment_store is not None else []
+	})
+
+	journal_windows[shard.checkpoint_path] = checkpoint
+	metrics.inc('smm_windows_total')
+	shard.windows_since_compaction += 1
+
+	if shard.windows_since_compaction >= JOURNAL_CHECKPOINT_WINDOWS:
+		compact_journal()
+		shard.windows_since_compaction = 0
+
+	probe_planner.save()
+
+class TimelineShard:
+	def __init__(self, index: int, start_timestamp: int, end_timestamp: int, checkpoint_path: str):
+		self.index = index
+		self.start_timestamp = start_timestamp
+		self.end_timestamp = end_timestamp
+		self.checkpoint_path = checkpoint_path
+		self.current_timestamp = read_checkpoint(checkpoint_path, start_timestamp)
+		self.windows_since_compaction = 0
+		self.failed_objects = 0 # * Objects which could not be archived, see finish_windows
+
+def split_timeline(start_timestamp: int, end_timestamp: int, shard_count: int) -> list[tuple[int, int]]:
+	# * DateTime values are bit packed, so split on real seconds and convert back
+	start_seconds = common.DateTime(start_timestamp).timestamp()
+	end_seconds = common.DateTime(end_timestamp).timestamp()
+	shard_seconds = max((end_seconds - start_seconds) // shard_count, 1)
+
+	bounds = []
+
+	for i in range(shard_count):
+		shard_start = start_timestamp if i == 0 else bounds[-1][1]
+		shard_end = end_timestamp if i == shard_count - 1 else common.DateTime.fromtimestamp(start_seconds + (shard_seconds * (i + 1))).value()
+
+		bounds.append((shard_start, min(shard_end, end_timestamp)))
+
+	return bounds
+
+def create_timeline_shards() -> list[TimelineShard]:
+	if CRAWL_MODE == 'updates':
+		# * Updates are walked up to the current time, so the bounds change every run and can't be sharded
+		return [TimelineShard(0, FIRST_UPLOAD_TIMESTAMP, min(common.DateTime.now().value(), MAX_TIMESTAMP), 'last-updated-timestamp.txt')]
+
+	if SHARD_COUNT <= 1:
+		# * Unsharded scans keep using the original checkpoint file
+		return [TimelineShard(0, last_checked_timestamp, MAX_TIMESTAMP, 'last-checked-timestamp.txt')]
+
+	# * Shard bounds are always derived from last-checked-timestamp.txt, which is not
+	# * updated while sharding. This keeps the bounds stable between runs, so each
+	# * shards checkpoint can be resumed as long as SHARD_COUNT is not changed
+	shards = []
+
+	for i, (start_timestamp, end_timestamp) in enumerate(split_timeline(last_checked_timestamp, MAX_TIMESTAMP, SHARD_COUNT)):
+		checkpoint_path = 'last-checked-timestamp-%d-of-%d.txt' % (i + 1, SHARD_COUNT)
+		shards.append(TimelineShard(i, start_timestamp, end_timestamp, checkpoint_path))
+
+	return shards
+
+async def scan_timeline_shard(shard: TimelineShard):
+	current_timestamp = shard.current_timestamp
+	window_sizer = SearchWindowSizer(search_window_density, SEARCH_PAGE_SIZE, SEARCH_WINDOW_SECONDS, ADAPTIVE_SEARCH_WINDOW)
+	page_offset = 0 # * Offset into the current window, while paging through it
+	window_objects = 0
+	boundary_data_ids = set() # * Objects uploaded at current_timestamp which were already returned
+
+	async with start_window_finisher(shard) as windows:
+		while current_timestamp < shard.end_timestamp:
+			start_datetime = common.DateTime(current_timestamp)
+			start_seconds = start_datetime.timestamp()
+
+			if page_offset == 0:
+				end_timestamp = common.DateTime.fromtimestamp(start_seconds + window_sizer.next_window(start_seconds)).value()
+				end_datetime = common.DateTime(min(end_timestamp, shard.end_timestamp))
+
+			print("[Shard %d] Downloading next %d objects between %s to %s" % (shard.index, SEARCH_PAGE_SIZE, start_datetime, end_datetime))
+
+			param = datastore_smm.DataStoreSearchParam()
+			param.result_range.size = SEARCH_PAGE_SIZE
+			param.result_option = 0xFF
+
+			if CRAWL_MODE == 'updates':
+				param.updated_after = start_datetime
+				param.updated_before = end_datetime
+			else:
 				param.created_after = start_datetime
 				param.created_before = end_datetime
-				param.result_range.size = 100 # * Throws DataStore::InvalidArgument for anything higher than 100
-				param.result_option = 0xFF
 
-				search_object_response = await datastore_smm_client.search_object(param)
-				objects = search_object_response.result
+			param.result_range.offset = page_offset
+
+			search_object_response = await session_pool.call(datastore_smm.DataStoreClientSMM.search_object, param)
+			objects = search_object_response.result
+
+			# * Objects are skipped before any requests are made for them
+			if CRAWL_MODE == 'updates':
+				pending = [obj for obj in objects if has_changed(obj)]
 
-				print("Found %d objects" % len(objects))
+				print("[Shard %d] Found %d objects, %d changed" % (shard.index, len(objects), len(pending)))
+				metrics.inc('archive_objects_total', len(objects) - len(pending), result='skipped')
+			else:
+				# * Windows start at the upload time of the last object found, so
+				# * the objects uploaded at that time are returned again
+				new_objects = [obj for obj in objects if obj.data_id not in boundary_data_ids]
+				pending = [obj for obj in new_objects if not is_archived(obj)]
 
-				# * Process all objects at once
-				async with anyio.create_task_group() as tg:
-					for obj in objects:
-						tg.start_soon(process_datastore_object, obj)
+				print("[Shard %d] Found %d objects, %d already returned, %d already archived" % (shard.index, len(objects), len(objects) - len(new_objects), len(new_objects) - len(pending)))
+				metrics.inc('smm_search_duplicates_total', len(objects) - len(new_objects))
+				metrics.inc('archive_objects_total', len(new_objects) - len(pending), result='skipped')
 
-				last_checked_timestamp_file.seek(0)
-				last_checked_timestamp_file.write(str(current_timestamp))
+			metrics.inc('smm_search_objects_total', len(objects))
 
-				last_object_upload_timestamp = objects[-1].create_time.value()
+			if CRAWL_MODE == 'updates':
+				window_objects += len(objects)
 
-				if last_object_upload_timestamp >= max_timestamp:
-					print("Max timestamp reached. Stop searching")
-					keep_searching = False
-				elif len(objects) > 0:
-					print("More objects may be available, trying new offset!")
-					# * Set new timestamp to the upload date of the last
-					# * returned object, so we don't skip any
-					current_timestamp = last_object_upload_timestamp
+				if len(objects) == SEARCH_PAGE_SIZE:
+					# * Results are not ordered by update time, so the rest of the
+					# * window is read one page at a time. The checkpoint stays at
+					# * the start of the window until every page is done
+					page_offset += SEARCH_PAGE_SIZE
 				else:
-					print("No more objects available!")
-					keep_searching = False
+					# * The whole window was read, so it's density is known exactly
+					window_sizer.update(start_seconds, end_datetime.timestamp(), window_objects, end_datetime.timestamp())
+					current_timestamp = end_datetime.value()
+					page_offset = 0
+					window_objects = 0
+			else:
+				window_objects += len(objects)
+
+				if len(objects) == SEARCH_PAGE_SIZE and objects[-1].create_time.value() == current_timestamp:
+					# * A whole page of objects uploaded at the same time. Moving the
+					# * window start would never get past them, so read the next page
+					# * of the same window instead. The page covers no time at all, so
+					# * the window's density is only recorded once paging is done
+					boundary_data_ids.update(obj.data_id for obj in objects)
+					page_offset += SEARCH_PAGE_SIZE
+				else:
+					# * After paging there can be a full page's worth of objects in a window
+					# * which was read to the end, so its end is passed as the last object
+					last_object_seconds = objects[-1].create_time.timestamp() if len(objects) == SEARCH_PAGE_SIZE else end_datetime.timestamp()
+					window_sizer.update(start_seconds, end_datetime.timestamp(), window_objects, last_object_seconds)
+					window_objects = 0
+
+					if len(objects) == SEARCH_PAGE_SIZE:
+						# * The window may have more objects. Set new timestamp to the
+						# * upload date of the last returned object, so we don't skip any
+						current_timestamp = objects[-1].create_time.value()
+						boundary_data_ids = {obj.data_id for obj in objects if obj.create_time.value() == current_timestamp}
+						page_offset = 0
+					else:
+						# * Every object in the window was returned, move on to the next one
+						current_timestamp = end_datetime.value()
+						boundary_data_ids = set()
+						page_offset = 0
+
+			await queue_window(windows, pending, current_timestamp)
+			search_window_density.save()
+
+	if shard.failed_objects > 0:
+		compact_journal()
+
+		print("[Shard %d] Max timestamp reached, but %d objects failed. The next run resumes from the first window with a failed object" % (shard.index, shard.failed_objects))
+		return
+
+	journal_windows[shard.checkpoint_path] = shard.end_timestamp
+	compact_journal()
+
+	print("[Shard %d] Max timestamp reached. Stop searching" % shard.index)
+
+class IdRangeShard:
+	def __init__(self, index: int, shard_count: int, start_data_id: int, checkpoint_path: str):
+		# * Shards take turns checking batches of data IDs, so the shards
+		# * stay the same no matter how many objects there are
+		self.index = index
+		self.stride = ID_BATCH_SIZE * shard_count
+		self.checkpoint_path = checkpoint_path
+		self.next_data_id = read_checkpoint(checkpoint_path, start_data_id + (ID_BATCH_SIZE * index))
+		self.windows_since_compaction = 0
+		self.failed_objects = 0 # * Objects which could not be archived, see finish_windows
+
+async def find_data_id_range() -> tuple[int, int]:
+	# * Data IDs to check are bounded by the oldest and newest objects
+	data_ids = []
+
+	for result_order in [0, 1]: # * Ascending, then descending
+		param = datastore_smm.DataStoreSearchParam()
+		param.result_order = result_order
+		param.result_range.size = 1
+		param.result_option = 0
+
+		search_object_response = await session_pool.call(datastore_smm.DataStoreClientSMM.search_object, param)
+		data_ids.append(search_object_response.result[0].data_id)
+
+	return data_ids[0], data_ids[1] + 1
+
+def create_id_range_shards(first_data_id: int) -> list[IdRangeShard]:
+	if SHARD_COUNT <= 1:
+		return [IdRangeShard(0, 1, first_data_id, 'last-checked-data-id.txt')]
+
+	# * Like timeline shards, the shards are made from last-checked-data-id.txt, which is not updated while sharding
+	start_data_id = read_checkpoint('last-checked-data-id.txt', first_data_id)
+
+	return [IdRangeShard(i, SHARD_COUNT, start_data_id, 'last-checked-data-id-%d-of-%d.txt' % (i + 1, SHARD_COUNT)) for i in range(SHARD_COUNT)]
+
+async def get_metas_chunk(infos: dict[int, list[datastore_smm.DataStoreMetaInfo]], index: int, data_ids: list[int]):
+	params = []
+
+	for data_id in data_ids:
+		param = datastore_smm.DataStoreGetMetaParam()
+		param.data_id = data_id
+		param.result_option = 0xFF
+
+		params.append(param)
+
+	metas = await session_pool.call(datastore_smm.DataStoreClientSMM.get_metas_multiple_param, params)
+	infos[index] = metas.infos
+
+async def get_metas(data_ids: list[int]) -> list[datastore_smm.DataStoreMetaInfo]:
+	# * NintendoClients sends each PRUDP fragment of a request on it's own, so
+	# * a request made on the same session in the meantime can be sent between
+	# * them, and the server gets both corrupted. With structure headers each
+	# * data ID adds 33 bytes, so requests with more than 38 are over one 1300
+	# * byte fragment. They are split up, and sent at once so a batch still
+	# * takes one round trip
+	infos = {}
+
+	async with anyio.create_task_group() as tg:
+		for i in range(0, len(data_ids), META_LOOKUPS_PER_REQUEST):
+			tg.start_soon(get_metas_chunk, infos, i, data_ids[i:i + META_LOOKUPS_PER_REQUEST])
+
+	return [obj for i in sorted(infos) for obj in infos[i]]
+
+async def sweep_id_range_shard(shard: IdRangeShard, end_data_id: int):
+	async with start_window_finisher(shard) as windows:
+		while shard.next_data_id < end_data_id:
+			data_ids = list(range(shard.next_data_id, min(shard.next_data_id + ID_BATCH_SIZE, end_data_id)))
+
+			print("[Shard %d] Checking objects %d through %d" % (shard.index, data_ids[0], data_ids[-1]))
+
+			# * IDs with no object, or which can't be seen, come back with a data ID of 0
+			objects = [obj for obj in await get_metas(data_ids) if obj.data_id != 0]
+			pending = [obj for obj in objects if not is_archived(obj)]
+
+			print("[Shard %d] Found %d objects, %d already archived" % (shard.index, len(objects), len(objects) - len(pending)))
+			metrics.inc('archive_objects_total', len(data_ids) - len(objects), result='missing')
+			metrics.inc('archive_objects_total', len(objects) - len(pending), result='skipped')
+
+			shard.next_data_id += shard.stride
+
+			await queue_window(windows, pending, shard.next_data_id)
+
+	# * The checkpoint is left where it stopped, so the next run carries on with any newer objects
+	compact_journal()
+
+	if shard.failed_objects > 0:
+		print("[Shard %d] Newest object reached, but %d objects failed. The next run resumes from the first batch with a failed object" % (shard.index, shard.failed_objects))
+		return
+
+	print("[Shard %d] Newest object reached. Stop checking" % shard.index)
+
+def read_credentials() -> list[tuple[str, str]]:
+	# * Extra accounts are set as NEX_USERNAME_2, NEX_PASSWORD_2 and so on
+	credentials = [(NEX_USERNAME, NEX_PASSWORD)]
+	account = 2
+
+	while os.getenv('NEX_USERNAME_%d' % account) and os.getenv('NEX_PASSWORD_%d' % account):
+		credentials.append((os.getenv('NEX_USERNAME_%d' % account), os.getenv('NEX_PASSWORD_%d' % account)))
+		account += 1
+
+	return credentials
+
+async def main():
+	s = settings.default()
+	s.configure("9f2b4678", 30810)
+
+	async with start_metrics_exporter(metrics, METRICS_PORT, METRICS_FILE, METRICS_INTERVAL), start_session_pool(s, NEX_HOST, NEX_PORT, read_credentials(), NEX_SESSIONS_PER_ACCOUNT) as sessions:
+		global session_pool
+		global writer_stage
+		global download_budget
+		global s3_pool
+		global pipeline
+		session_pool = sessions
+		download_budget = ByteBudget(MAX_DOWNLOAD_BYTES_IN_FLIGHT)
+
+		if CRAWL_MODE == 'ids':
+			first_data_id, end_data_id = await find_data_id_range()
+			shards = create_id_range_shards(first_data_id)
+		else:
+			shards = create_timeline_shards()
+
+		async with start_writer_stage(WRITER_THREADS, WRITER_QUEUE_SIZE) as stage:
+			async with create_connection_pool(S3_MAX_CONNECTIONS, S3_MAX_CONNECTIONS_PER_HOST, S3_IDLE_TIMEOUT) as pool:
+				writer_stage = stage
+				s3_pool = pool
+
+				async with start_pipeline(create_pipeline_stages(), PIPELINE_QUEUE_SIZE, object_failed) as pipeline_input:
+					pipeline = pipeline_input
+
+					# * Scan every shard at the same time, all feeding the same pipeline
+					async with anyio.create_task_group() as tg:
+						for shard in shards:
+							if CRAWL_MODE == 'ids':
+								tg.start_soon(sweep_id_range_shard, shard, end_data_id)
+							else:
+								tg.start_soon(scan_timeline_shard, shard)
 
 anyio.run(main)
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import anyio
+import sqlite3
+import logging
+import argparse
+import tempfile
+from fake_server import add_server_arguments, generate_objects, start_fake_server
+
+# * Runs archive.py against fake_server.py in a temporary directory and reports
+# * how fast it archived. Any settings archive.py reads from the environment
+# * (SHARD_COUNT, WRITER_THREADS, S3_MAX_CONNECTIONS, ...) are passed through,
+# * so changes can be compared by running this once with each setting
+
+ARCHIVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive.py')
+
+def read_results(work_path: str) -> tuple[int, int]:
+	conn = sqlite3.connect(os.path.join(work_path, 'manifest.db'))
+	row = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM manifest').fetchone()
+	conn.close()
+
+	return row
+
+async def run_archive(work_path: str, host: str, port: int, log_path: str) -> int:
+	env = dict(os.environ)
+	env.update({
+		'NEX_HOST': host,
+		'NEX_PORT': str(port),
+		'NEX_USERNAME': '1000000000',
+		'NEX_PASSWORD': '1000000000',
+	})
+
+	# * archive.py prints every object, which is kept out of the results
+	with open(log_path, 'wb') as log_file:
+		process = await anyio.open_process([sys.executable, ARCHIVE_PATH], cwd=work_path, env=env, stdout=log_file, stderr=log_file)
+
+		async with process:
+			return await process.wait()
+
+async def main():
+	logging.basicConfig(level=logging.ERROR) # * Hides the warning logged for every rejected probe
+
+	parser = argparse.ArgumentParser(description='Benchmark archive.py against a local fake SMM DataStore server')
+	add_server_arguments(parser)
+	parser.add_argument('--work-dir', help='Where archive.py writes its files. A temporary directory is used if not set')
+	args = parser.parse_args()
+
+	objects = generate_objects(args.objects, args.object_size, args.seed, args.update_fraction, args.hidden_fraction)
+	work_path = args.work_dir or tempfile.mkdtemp(prefix='smm-benchmark-')
+	log_path = os.path.join(work_path, 'archive.log')
+
+	os.makedirs(work_path, exist_ok=True)
+
+	print("Archiving %d objects (%.1f MiB) from %s:%d into %s" % (len(objects), sum(obj.size for obj in objects) / (1024 * 1024), args.host, args.port, work_path))
+
+	async with start_fake_server(args.host, args.port, objects, args.latency, args.http_latency, args.error_rate, args.seed) as backend:
+		start = time.monotonic()
+		return_code = await run_archive(work_path, args.host, args.port, log_path)
+		elapsed = time.monotonic() - start
+
+	if return_code != 0:
+		# * A crawl which did not finish says nothing about how fast archive.py is
+		sys.exit("archive.py exited with %d, see %s" % (return_code, log_path))
+
+	archived, archived_bytes = read_results(work_path)
+
+	print("Archived %d of %d objects in %.2f seconds" % (archived, len(objects), elapsed))
+	print("%.2f objects/sec, %.2f MiB/sec" % (archived / elapsed, (archived_bytes / (1024 * 1024)) / elapsed))
+	print("Requests:")
+
+	for method, count in sorted(backend.requests.items()):
+		print("  %s: %d (%.2f per object)" % (method, count, count / max(archived, 1)))
+
+if __name__ == '__main__':
+	anyio.run(main)
@@ -0,0 +1,141 @@
+from nintendo.nex import common, rmc, datastore_smm, streams
+
+"""
+	Beginning of everything not implemented in NintendoClients
+"""
+
+class DataStoreGetCustomRankingByDataIdParam(common.Structure):
+	def __init__(self):
+		super().__init__()
+		self.application_id = None
+		self.data_id_list = None
+		self.result_option = None
+	
+	def load(self, stream: streams.StreamIn, version: int):
+		self.application_id = stream.u32()
+		self.data_id_list = stream.list(stream.u64)
+		self.result_option = stream.u8()
+	
+	def save(self, stream: streams.StreamIn, version: int):
+		stream.u32(self.application_id)
+		stream.list(self.data_id_list, stream.u64)
+		stream.u8(self.result_option)
+
+class DataStoreCustomRankingResult(common.Structure):
+	def __init__(self):
+		super().__init__()
+		self.order = None
+		self.score = None
+		self.meta_info = None
+	
+	def load(self, stream: streams.StreamIn, version: int):
+		self.order = stream.u32()
+		self.score = stream.u32()
+		self.meta_info = stream.extract(datastore_smm.DataStoreMetaInfo)
+	
+	def save(self, stream: streams.StreamIn, version: int):
+		stream.u32(self.order)
+		stream.u32(self.score)
+		stream.add(self.meta_info)
+
+class BufferQueueParam(common.Structure):
+	def __init__(self):
+		super().__init__()
+		self.data_id = None
+		self.slot = None
+	
+	def load(self, stream: streams.StreamIn, version: int):
+		self.data_id = stream.u64()
+		self.slot = stream.u32()
+	
+	def save(self, stream: streams.StreamIn, version: int):
+		stream.u64(self.data_id)
+		stream.u32(self.slot)
+
+class DataStoreGetCourseRecordParam(common.Structure):
+	def __init__(self):
+		super().__init__()
+		self.data_id = None
+		self.slot = None
+	
+	def load(self, stream: streams.StreamIn, version: int):
+		self.data_id = stream.u64()
+		self.slot = stream.u8()
+	
+	def save(self, stream: streams.StreamIn, version: int):
+		stream.u64(self.data_id)
+		stream.u8(self.slot)
+
+class DataStoreGetCourseRecordResult(common.Structure):
+	def __init__(self):
+		super().__init__()
+		self.data_id = None
+		self.slot = None
+		self.first_pid = None
+		self.best_pid = None
+		self.best_score = None
+		self.created_time = None
+		self.updated_time = None
+	
+	def load(self, stream: streams.StreamIn, version: int):
+		self.data_id = stream.u64()
+		self.slot = stream.u8()
+		self.first_pid = stream.u32()
+		self.best_pid = stream.u32()
+		self.best_score = stream.s32()
+		self.created_time = stream.datetime()
+		self.updated_time = stream.datetime()
+	
+	def save(self, stream: streams.StreamIn, version: int):
+		stream.u64(self.data_id)
+		stream.u8(self.slot)
+		stream.u32(self.first_pid)
+		stream.u32(self.best_pid)
+		stream.s32(self.best_score)
+		stream.datetime(self.created_time)
+		stream.datetime(self.updated_time)
+
+async def get_custom_ranking_by_data_id(datastore_smm_client: datastore_smm.DataStoreClientSMM, param: DataStoreGetCustomRankingByDataIdParam) -> rmc.RMCResponse:
+	# * --- request ---
+	stream = streams.StreamOut(datastore_smm_client.settings)
+	stream.add(param)
+	data = await datastore_smm_client.client.request(datastore_smm_client.PROTOCOL_ID, 50, stream.get())
+
+	# * --- response ---
+	stream = streams.StreamIn(data, datastore_smm_client.settings)
+
+	obj = rmc.RMCResponse()
+	obj.ranking_result = stream.list(DataStoreCustomRankingResult)
+	obj.results = stream.list(common.Result)
+
+	return obj
+
+async def get_buffer_queue(datastore_smm_client: datastore_smm.DataStoreClientSMM, param: BufferQueueParam) -> list[bytes]:
+	# * --- request ---
+	stream = streams.StreamOut(datastore_smm_client.settings)
+	stream.add(param)
+	data = await datastore_smm_client.client.request(datastore_smm_client.PROTOCOL_ID, 54, stream.get())
+
+	# * --- response ---
+	stream = streams.StreamIn(data, datastore_smm_client.settings)
+
+	result = stream.list(stream.qbuffer)
+
+	return result
+
+async def get_course_record(datastore_smm_client: datastore_smm.DataStoreClientSMM, param: DataStoreGetCourseRecordParam) -> DataStoreGetCourseRecordResult:
+	# * --- request ---
+	stream = streams.StreamOut(datastore_smm_client.settings)
+	stream.add(param)
+	data = await datastore_smm_client.client.request(datastore_smm_client.PROTOCOL_ID, 72, stream.get())
+
+	# * --- response ---
+	stream = streams.StreamIn(data, datastore_smm_client.settings)
+
+	result = stream.extract(DataStoreGetCourseRecordResult)
+
+	return result
+
+"""
+	End of everything not implemented in NintendoClients
+"""
@@ -0,0 +1,32 @@
+import os
+from segment_store import SegmentStore
+
+# * Unpacks ./segments back into the same files archive.py writes when
+# * OUTPUT_FORMAT is "files". Objects go to ./objects, and sidecars go
+# * to a directory named after the sidecar
+
+def main():
+	segment_store = SegmentStore('./segments', 0)
+	extracted = 0
+
+	for data_id, version, kind in segment_store.records().fetchall():
+		if kind == 'object':
+			path = './objects/%d_v%d.bin' % (data_id, version)
+		else:
+			path = './%s/%d_v%d.json.gz' % (kind, data_id, version)
+
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		with open(path, 'wb') as output_file:
+			output_file.write(segment_store.read(data_id, version, kind))
+
+		extracted += 1
+
+		if extracted % 10000 == 0:
+			print("Extracted %d records" % extracted)
+
+	segment_store.close()
+
+	print("Extracted %d records" % extracted)
+
+main()
@@ -0,0 +1,467 @@
+import hmac
+import logging
+import random
+import struct
+import hashlib
+import secrets
+import argparse
+import anyio
+import anyio.abc
+import contextlib
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+from nintendo.nex import authentication, common, datastore_smm, kerberos, rmc, settings, streams
+from datastore_smm_extra import DataStoreGetCustomRankingByDataIdParam, DataStoreCustomRankingResult, BufferQueueParam, DataStoreGetCourseRecordParam, DataStoreGetCourseRecordResult
+
+# * A local stand-in for the SMM DataStore server, for benchmarking archive.py
+# * without touching the real server. Serves NEX authentication, the DataStore
+# * methods archive.py uses, and presigned-style HTTP URLs for object data
+
+ACCESS_KEY = '9f2b4678'
+NEX_VERSION = 30810
+SECURE_PID = 2
+FIRST_DATA_ID = 1000000
+FIRST_UPLOAD_TIMESTAMP = 135271087238 # * Same as archive.py
+MAX_TIMESTAMP = common.DateTime.make(2024, 4, 1).value()
+UNSET_TIME = common.DateTime.future().value() # * Default of every time in DataStoreSearchParam
+
+# * data_type -> which probes hit. Loosely based on what the real server returns
+COURSE_DATA_TYPE = 0
+DATA_TYPES = [ 0, 0, 0, 1, 2, 3 ]
+COURSE_CUSTOM_RANKING_APPLICATION_IDS = [ 0, 2400, 3600 ]
+COURSE_BUFFER_QUEUE_SLOTS = [ 0, 3 ]
+
+def make_settings() -> settings.Settings:
+	s = settings.default()
+	s.configure(ACCESS_KEY, NEX_VERSION)
+
+	return s
+
+def missing_meta_info() -> datastore_smm.DataStoreMetaInfo:
+	# * What the real server returns for a data ID with no object, every field zero
+	meta_info = datastore_smm.DataStoreMetaInfo()
+	meta_info.data_id = 0
+	meta_info.owner_id = 0
+	meta_info.size = 0
+	meta_info.name = ''
+	meta_info.data_type = 0
+	meta_info.meta_binary = b''
+	meta_info.create_time = common.DateTime(0)
+	meta_info.update_time = common.DateTime(0)
+	meta_info.period = 0
+	meta_info.status = 0
+	meta_info.referred_count = 0
+	meta_info.refer_data_id = 0
+	meta_info.flag = 0
+	meta_info.referred_time = common.DateTime(0)
+	meta_info.expire_time = common.DateTime(0)
+	meta_info.tags = []
+	meta_info.ratings = []
+
+	return meta_info
+
+class FakeObject:
+	def __init__(self, data_id: int, data_type: int, create_time: int, size: int):
+		self.data_id = data_id
+		self.data_type = data_type
+		self.create_time = create_time
+		self.update_time = create_time
+		self.size = size
+		self.version = 1
+		self.hidden = False # * Hidden objects are never returned by searches
+
+	def meta_info(self) -> datastore_smm.DataStoreMetaInfo:
+		meta_info = datastore_smm.DataStoreMetaInfo()
+		meta_info.data_id = self.data_id
+		meta_info.owner_id = 1000000000 + (self.data_id % 100000)
+		meta_info.size = self.size
+		meta_info.name = 'Object %d' % self.data_id
+		meta_info.data_type = self.data_type
+		meta_info.meta_binary = struct.pack('>Q', self.data_id) * 4
+		meta_info.create_time = common.DateTime(self.create_time)
+		meta_info.update_time = common.DateTime(self.update_time)
+		meta_info.period = 90
+		meta_info.status = 0
+		meta_info.referred_count = 0
+		meta_info.refer_data_id = 0
+		meta_info.flag = 0
+		meta_info.referred_time = common.DateTime(self.create_time)
+		meta_info.expire_time = common.DateTime(671076024059)
+		meta_info.tags = []
+		meta_info.ratings = []
+
+		for slot in range(2):
+			rating = datastore_smm.DataStoreRatingInfoWithSlot()
+			rating.slot = slot
+			rating.info.total_value = (self.data_id * (slot + 7) * self.version) % 5000
+			rating.info.count = rating.info.total_value
+			rating.info.initial_value = 0
+
+			meta_info.ratings.append(rating)
+
+		return meta_info
+
+	def data(self) -> bytes:
+		# * Generated from the data ID, so nothing has to be kept in memory
+		block = hashlib.sha256(struct.pack('>Q', self.data_id)).digest()
+
+		return (block * ((self.size // len(block)) + 1))[:self.size]
+
+def generate_objects(count: int, object_size: int, seed: int, update_fraction: float = 0, hidden_fraction: float = 0) -> list[FakeObject]:
+	rng = random.Random(seed)
+	start_seconds = common.DateTime(FIRST_UPLOAD_TIMESTAMP).timestamp()
+	end_seconds = common.DateTime(MAX_TIMESTAMP).timestamp()
+	generated = []
+
+	for i in range(count):
+		create_time = common.DateTime.fromtimestamp(rng.randint(start_seconds, end_seconds - 1)).value()
+		size = rng.randint(max(object_size // 2, 1), object_size * 2)
+		generated.append((create_time, i, rng.choice(DATA_TYPES), size))
+
+	# * Data IDs go up with the upload time, like on the real server
+	generated.sort()
+	objects = [FakeObject(FIRST_DATA_ID + i, data_type, create_time, size) for i, (create_time, _, data_type, size) in enumerate(generated)]
+
+	# * Separate generator, so the same seed makes the same objects whether or not some are updated.
+	# * Updated objects have a new version with the same data, like a reupload which only changed metadata
+	update_rng = random.Random(seed + 1)
+
+	for obj in objects:
+		if update_rng.random() < update_fraction:
+			obj.version = 2
+			obj.update_time = common.DateTime.fromtimestamp(update_rng.randint(common.DateTime(obj.create_time).timestamp(), end_seconds - 1)).value()
+
+	hidden_rng = random.Random(seed + 2)
+
+	for obj in objects:
+		obj.hidden = hidden_rng.random() < hidden_fraction
+
+	return objects
+
+# * Shared by the NEX and HTTP servers
+class FakeBackend:
+	def __init__(self, objects: list[FakeObject], latency: float, error_rate: float, seed: int):
+		self.objects = [obj for obj in objects if not obj.hidden] # * Only what searches can return
+		self.objects_by_id = {obj.data_id: obj for obj in objects}
+		self.create_times = [obj.create_time for obj in self.objects]
+		self.objects_by_update = sorted(self.objects, key=lambda obj: (obj.update_time, obj.data_id))
+		self.update_times = [obj.update_time for obj in self.objects_by_update]
+		self.latency = latency
+		self.error_rate = error_rate
+		self.rng = random.Random(seed)
+		self.url_key = secrets.token_bytes(16)
+		self.http_base_url = None # * Gets set once the HTTP server is started
+		self.requests = {}
+
+	async def simulate(self, method: str):
+		self.requests[method] = self.requests.get(method, 0) + 1
+
+		if self.latency > 0:
+			await anyio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+
+		if self.rng.random() < self.error_rate:
+			raise common.RMCError('Core::SystemError')
+
+	def sign(self, path: str, expires: int) -> str:
+		return hmac.new(self.url_key, ('%s:%d' % (path, expires)).encode('utf-8'), hashlib.sha1).hexdigest()
+
+	def object_url(self, obj: FakeObject) -> str:
+		path = '/%020d-%05d' % (obj.data_id, obj.version)
+		expires = 4102444800 # * Only checked for a valid signature, not the time
+
+		return '%s%s?Expires=%d&Signature=%s' % (self.http_base_url, path, expires, self.sign(path, expires))
+
+	def object_for_path(self, target: str) -> FakeObject | None:
+		url = urlsplit(target)
+		query = parse_qs(url.query)
+
+		try:
+			expires = int(query['Expires'][0])
+			signature = query['Signature'][0]
+			data_id = int(url.path.lstrip('/').split('-')[0])
+		except (KeyError, ValueError, IndexError):
+			return None
+
+		if not hmac.compare_digest(signature, self.sign(url.path, expires)):
+			return None
+
+		return self.objects_by_id.get(data_id)
+
+class FakeAuthenticationServer(authentication.AuthenticationServer):
+	def __init__(self, settings: settings.Settings, secure_host: str, secure_port: int, secure_key: bytes):
+		super().__init__()
+		self.settings = settings
+		self.secure_host = secure_host
+		self.secure_port = secure_port
+		self.secure_key = secure_key
+		self.key_derivation = kerberos.KeyDerivationOld(65000, 1024)
+
+	async def login(self, client, username: str) -> rmc.RMCResponse:
+		# * Any numeric username is accepted, the password is the username
+		if not username.isdigit():
+			raise common.RMCError('RendezVous::InvalidUsername')
+
+		pid = int(username)
+		session_key = secrets.token_bytes(self.settings['kerberos.key_size'])
+
+		server_ticket = kerberos.ServerTicket()
+		server_ticket.timestamp = common.DateTime.now()
+		server_ticket.source = pid
+		server_ticket.session_key = session_key
+
+		client_ticket = kerberos.ClientTicket()
+		client_ticket.session_key = session_key
+		client_ticket.target = SECURE_PID
+		client_ticket.internal = server_ticket.encrypt(self.secure_key, self.settings)
+
+		connection_data = authentication.RVConnectionData()
+		connection_data.main_station = common.StationURL(
+			address=self.secure_host, port=self.secure_port, PID=SECURE_PID, CID=1, type=2, sid=1, stream=10
+		)
+		connection_data.server_time = common.DateTime.now()
+
+		response = rmc.RMCResponse()
+		response.result = common.Result.success()
+		response.pid = pid
+		response.ticket = client_ticket.encrypt(self.key_derivation.derive_key(username.encode(), pid), self.settings)
+		response.connection_data = connection_data
+		response.server_name = 'fake-smm'
+
+		return response
+
+class FakeDataStoreServer(datastore_smm.DataStoreServerSMM):
+	def __init__(self, backend: FakeBackend):
+		super().__init__()
+		self.backend = backend
+
+		# * Methods NintendoClients does not know about
+		self.methods[50] = self.handle_get_custom_ranking_by_data_id
+		self.methods[54] = self.handle_get_buffer_queue
+		self.methods[72] = self.handle_get_course_record
+
+	async def search_object(self, client, param: datastore_smm.DataStoreSearchParam) -> datastore_smm.DataStoreSearchResult:
+		await self.backend.simulate('search_object')
+
+		if param.updated_after.value() != UNSET_TIME:
+			# * Searching by update time
+			start = bisect_left(self.backend.update_times, param.updated_after.value())
+			end = bisect_left(self.backend.update_times, param.updated_before.value())
+			matches = self.backend.objects_by_update[start:end]
+		elif param.created_after.value() != UNSET_TIME:
+			start = bisect_left(self.backend.create_times, param.created_after.value())
+			end = bisect_left(self.backend.create_times, param.created_before.value())
+			matches = self.backend.objects[start:end]
+		else:
+			matches = self.backend.objects
+
+		if param.result_order == 1:
+			# * Descending
+			matches = matches[::-1]
+
+		page = matches[param.result_range.offset:param.result_range.offset + param.result_range.size]
+
+		result = datastore_smm.DataStoreSearchResult()
+		result.total_count = len(matches)
+		result.result = [obj.meta_info() for obj in page]
+		result.total_count_type = 0
+
+		return result
+
+	async def get_metas_multiple_param(self, client, params: list[datastore_smm.DataStoreGetMetaParam]) -> rmc.RMCResponse:
+		await self.backend.simulate('get_metas_multiple_param')
+
+		response = rmc.RMCResponse()
+		response.infos = []
+		response.results = []
+
+		for param in params:
+			obj = self.backend.objects_by_id.get(param.data_id)
+
+			if obj is None:
+				response.infos.append(missing_meta_info())
+				response.results.append(common.Result.error('DataStore::NotFound'))
+			else:
+				response.infos.append(obj.meta_info())
+				response.results.append(common.Result.success())
+
+		return response
+
+	async def prepare_get_object(self, client, param: datastore_smm.DataStorePrepareGetParam) -> datastore_smm.DataStoreReqGetInfo:
+		await self.backend.simulate('prepare_get_object')
+
+		obj = self.backend.objects_by_id.get(param.data_id)
+
+		if obj is None:
+			raise common.RMCError('DataStore::NotFound')
+
+		info = datastore_smm.DataStoreReqGetInfo()
+		info.url = self.backend.object_url(obj)
+		info.headers = []
+		info.size = obj.size
+		info.root_ca_cert = b''
+		info.data_id = obj.data_id
+
+		return info
+
+	async def handle_get_custom_ranking_by_data_id(self, client, input: streams.StreamIn, output: streams.StreamOut):
+		param = input.extract(DataStoreGetCustomRankingByDataIdParam)
+
+		await self.backend.simulate('get_custom_ranking_by_data_id')
+
+		ranking_results = []
+		results = []
+
+		for data_id in param.data_id_list:
+			obj = self.backend.objects_by_id.get(data_id)
+
+			if obj is None or obj.data_type != COURSE_DATA_TYPE or param.application_id not in COURSE_CUSTOM_RANKING_APPLICATION_IDS:
+				results.append(common.Result.error('DataStore::NotFound'))
+				continue
+
+			ranking_result = DataStoreCustomRankingResult()
+			ranking_result.order = len(ranking_results) + 1
+			ranking_result.score = data_id % 1000
+			ranking_result.meta_info = obj.meta_info()
+
+			ranking_results.append(ranking_result)
+			results.append(common.Result.success())
+
+		if not ranking_results:
+			raise common.RMCError('DataStore::NotFound')
+
+		output.list(ranking_results, output.add)
+		output.list(results, output.result)
+
+	async def handle_get_buffer_queue(self, client, input: streams.StreamIn, output: streams.StreamOut):
+		param = input.extract(BufferQueueParam)
+
+		await self.backend.simulate('get_buffer_queue')
+
+		obj = self.backend.objects_by_id.get(param.data_id)
+
+		if obj is None or obj.data_type != COURSE_DATA_TYPE or param.slot not in COURSE_BUFFER_QUEUE_SLOTS:
+			raise common.RMCError('DataStore::NotFound')
+
+		output.list([struct.pack('>QI', param.data_id, param.slot)], output.qbuffer)
+
+	async def handle_get_course_record(self, client, input: streams.StreamIn, output: streams.StreamOut):
+		param = input.extract(DataStoreGetCourseRecordParam)
+
+		await self.backend.simulate('get_course_record')
+
+		obj = self.backend.objects_by_id.get(param.data_id)
+
+		if obj is None or obj.data_type != COURSE_DATA_TYPE or param.slot != 0:
+			raise common.RMCError('DataStore::NotFound')
+
+		record = DataStoreGetCourseRecordResult()
+		record.data_id = obj.data_id
+		record.slot = param.slot
+		record.first_pid = 1000000000
+		record.best_pid = 1000000001
+		record.best_score = obj.data_id % 100000
+		record.created_time = common.DateTime(obj.create_time)
+		record.updated_time = common.DateTime(obj.create_time)
+
+		output.add(record)
+
+async def handle_http_client(backend: FakeBackend, http_latency: float, client):
+	# * Keep-alive is supported, so connection reuse in archive.py can be measured
+	async with client:
+		buffer = b''
+
+		while True:
+			try:
+				while b'\r\n\r\n' not in buffer:
+					data = await client.receive()
+					buffer += data
+			except (anyio.EndOfStream, anyio.BrokenResourceError):
+				return
+
+			head, buffer = buffer.split(b'\r\n\r\n', 1)
+			lines = head.decode('latin-1').split('\r\n')
+			method, target, version = lines[0].split(' ', 2)
+			keep_alive = not any(line.lower() == 'connection: close' for line in lines[1:])
+
+			backend.requests['http_get'] = backend.requests.get('http_get', 0) + 1
+
+			if http_latency > 0:
+				await anyio.sleep(http_latency * backend.rng.uniform(0.5, 1.5))
+
+			obj = backend.object_for_path(target) if method == 'GET' else None
+
+			if obj is None:
+				status, body = '403 Forbidden', b'<Error><Code>AccessDenied</Code></Error>'
+			elif backend.rng.random() < backend.error_rate:
+				status, body = '503 Slow Down', b'<Error><Code>SlowDown</Code></Error>'
+			else:
+				status, body = '200 OK', obj.data()
+
+			response = 'HTTP/1.1 %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' % (status, len(body), 'keep-alive' if keep_alive else 'close')
+
+			try:
+				await client.send(response.encode('latin-1') + body)
+			except anyio.BrokenResourceError:
+				return
+
+			if not keep_alive:
+				return
+
+async def serve_http(backend: FakeBackend, host: str, port: int, http_latency: float, task_status=anyio.TASK_STATUS_IGNORED):
+	listener = await anyio.create_tcp_listener(local_host=host, local_port=port)
+	port = listener.extra(anyio.abc.SocketAttribute.local_port)
+	backend.http_base_url = 'http://%s:%d' % (host, port)
+
+	task_status.started(port)
+
+	await listener.serve(lambda client: handle_http_client(backend, http_latency, client))
+
+# * Starts the fake authentication, secure and HTTP servers. The authentication
+# * server is on "port", the secure server on "port" + 1 and the HTTP server on "port" + 2
+@contextlib.asynccontextmanager
+async def start_fake_server(host: str, port: int, objects: list[FakeObject], latency: float, http_latency: float, error_rate: float, seed: int):
+	s = make_settings()
+	backend = FakeBackend(objects, latency, error_rate, seed)
+	secure_key = secrets.token_bytes(16)
+
+	auth_servers = [ FakeAuthenticationServer(s, host, port + 1, secure_key) ]
+	secure_servers = [ FakeDataStoreServer(backend) ]
+
+	async with rmc.serve(s, auth_servers, host, port):
+		async with rmc.serve(s, secure_servers, host, port + 1, key=secure_key):
+			async with anyio.create_task_group() as tg:
+				await tg.start(serve_http, backend, host, port + 2, http_latency)
+
+				try:
+					yield backend
+				finally:
+					tg.cancel_scope.cancel()
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=59900, help='Authentication server port. The secure server uses port + 1, and HTTP port + 2')
+	parser.add_argument('--objects', type=int, default=10000, help='Number of objects spread over the SMM timeline')
+	parser.add_argument('--object-size', type=int, default=16384, help='Average object size in bytes')
+	parser.add_argument('--latency', type=float, default=0.05, help='Average seconds taken by each NEX request')
+	parser.add_argument('--http-latency', type=float, default=0.02, help='Average seconds before each HTTP response')
+	parser.add_argument('--error-rate', type=float, default=0, help='Chance of a NEX request or HTTP request failing')
+	parser.add_argument('--update-fraction', type=float, default=0, help='Fraction of objects which have a second version, with a later update time')
+	parser.add_argument('--hidden-fraction', type=float, default=0, help='Fraction of objects which searches never return, but can still be found by data ID')
+	parser.add_argument('--seed', type=int, default=0)
+
+async def main():
+	logging.basicConfig(level=logging.ERROR) # * Hides the warning logged for every rejected probe
+
+	parser = argparse.ArgumentParser(description='Fake SMM DataStore server for offline benchmarks')
+	add_server_arguments(parser)
+	args = parser.parse_args()
+
+	objects = generate_objects(args.objects, args.object_size, args.seed, args.update_fraction, args.hidden_fraction)
+
+	async with start_fake_server(args.host, args.port, objects, args.latency, args.http_latency, args.error_rate, args.seed):
+		print("Serving %d objects. Set NEX_HOST=%s and NEX_PORT=%d, and use any numeric NEX_USERNAME with the same value as NEX_PASSWORD" % (len(objects), args.host, args.port))
+
+		await anyio.sleep_forever()
+
+if __name__ == '__main__':
+	anyio.run(main)
@@ -0,0 +1,72 @@
+import os
+import re
+import hashlib
+from manifest import Manifest
+
+# * Builds manifest.db from an archive made before the manifest existed.
+# * Only needs to be ran once. Each directory is listed once, rather than
+# * checking every file on it's own
+
+OBJECT_FILE_NAME = re.compile(r'^(\d+)_v(\d+)\.bin$')
+SIDECAR_FILE_NAME = re.compile(r'^(\d+)_v(\d+)\.json\.gz$')
+SIDECARS = [ 'metadata', 'custom-rankings', 'buffer-queues', 'course-records' ]
+BATCH_SIZE = 10000
+
+def list_sidecars(sidecar: str) -> set[tuple[int, int]]:
+	found = set()
+
+	if not os.path.isdir('./%s' % sidecar):
+		return found
+
+	with os.scandir('./%s' % sidecar) as entries:
+		for entry in entries:
+			match = SIDECAR_FILE_NAME.match(entry.name)
+
+			if match:
+				found.add((int(match.group(1)), int(match.group(2))))
+
+	return found
+
+def hash_file(path: str) -> str:
+	sha256 = hashlib.sha256()
+
+	with open(path, 'rb') as object_file:
+		for chunk in iter(lambda: object_file.read(1024 * 1024), b''):
+			sha256.update(chunk)
+
+	return sha256.hexdigest()
+
+def main():
+	manifest = Manifest('manifest.db')
+	sidecars = {sidecar: list_sidecars(sidecar) for sidecar in SIDECARS}
+	rows = []
+	imported = 0
+
+	with os.scandir('./objects') as entries:
+		for entry in entries:
+			match = OBJECT_FILE_NAME.match(entry.name)
+
+			if not match:
+				continue
+
+			data_id = int(match.group(1))
+			version = int(match.group(2))
+			written_sidecars = [sidecar for sidecar in SIDECARS if (data_id, version) in sidecars[sidecar]]
+
+			rows.append((data_id, version, entry.stat().st_size, hash_file(entry.path), written_sidecars))
+
+			if len(rows) >= BATCH_SIZE:
+				manifest.record_many(rows)
+				manifest.commit()
+				imported += len(rows)
+				rows = []
+
+				print("Imported %d objects" % imported)
+
+	manifest.record_many(rows)
+	manifest.close()
+	imported += len(rows)
+
+	print("Imported %d objects" % imported)
+
+main()
@@ -0,0 +1,62 @@
+import os
+import re
+import gzip
+import json
+from metadata_store import MetadataStore
+from segment_store import SegmentStore
+
+# * Builds metadata.db from the metadata files of an archive made before
+# * metadata.db existed. Reads both ./metadata and ./segments, so it works
+# * with either OUTPUT_FORMAT. Safe to run more than once
+
+METADATA_FILE_NAME = re.compile(r'^(\d+)_v(\d+)\.json\.gz$')
+BATCH_SIZE = 10000
+
+def read_metadata_files():
+	if not os.path.isdir('./metadata'):
+		return
+
+	with os.scandir('./metadata') as entries:
+		for entry in entries:
+			match = METADATA_FILE_NAME.match(entry.name)
+
+			if match:
+				with gzip.open(entry.path, 'rb') as metadata_file:
+					yield int(match.group(2)), json.loads(metadata_file.read())
+
+def read_metadata_segments():
+	if not os.path.isfile('./segments/index.db'):
+		return
+
+	segment_store = SegmentStore('./segments', 0)
+
+	for data_id, version, kind in segment_store.records().fetchall():
+		if kind == 'metadata':
+			yield version, json.loads(gzip.decompress(segment_store.read(data_id, version, kind)))
+
+	segment_store.close()
+
+def main():
+	metadata_store = MetadataStore('metadata.db')
+	rows = []
+	imported = 0
+
+	for source in [read_metadata_files(), read_metadata_segments()]:
+		for row in source:
+			rows.append(row)
+
+			if len(rows) >= BATCH_SIZE:
+				metadata_store.record_many(rows)
+				metadata_store.commit()
+				imported += len(rows)
+				rows = []
+
+				print("Imported %d objects" % imported)
+
+	metadata_store.record_many(rows)
+	metadata_store.close()
+	imported += len(rows)
+
+	print("Imported %d objects" % imported)
+
+main()
@@ -0,0 +1,68 @@
+import os
+import json
+import zlib
+import threading
+
+# * Write-ahead journal of crawl progress. Every record is one line holding the
+# * CRC32 of the record followed by the record as JSON, and is fsynced before
+# * append returns. A crash can only ever cut off the last line, which is
+# * detected by the CRC and dropped when the journal is replayed
+class Journal:
+	def __init__(self, path: str):
+		self.path = path
+		self.lock = threading.Lock()
+		self.journal_file = None
+
+	def replay(self) -> list[dict]:
+		records = []
+		good_length = 0
+
+		if os.path.isfile(self.path):
+			with open(self.path, 'rb') as journal_file:
+				for line in journal_file:
+					record = self.parse(line)
+
+					if record is None:
+						# * Torn write, nothing after this was made durable
+						break
+
+					records.append(record)
+					good_length += len(line)
+
+		self.journal_file = open(self.path, 'ab')
+		self.journal_file.truncate(good_length)
+
+		return records
+
+	def parse(self, line: bytes) -> dict | None:
+		if not line.endswith(b'\n'):
+			return None
+
+		try:
+			crc, data = line[:-1].split(b' ', 1)
+
+			if int(crc, 16) != zlib.crc32(data):
+				return None
+
+			return json.loads(data)
+		except ValueError:
+			return None
+
+	def append(self, record: dict):
+		data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+
+		with self.lock:
+			self.journal_file.write(b'%08x %s\n' % (zlib.crc32(data), data))
+			self.journal_file.flush()
+			os.fsync(self.journal_file.fileno())
+
+	def reset(self):
+		# * Only safe once everything in the journal has been made durable somewhere else
+		with self.lock:
+			self.journal_file.truncate(0)
+			self.journal_file.flush()
+			os.fsync(self.journal_file.fileno())
+
+	def close(self):
+		if self.journal_file is not None:
+			self.journal_file.close()
@@ -0,0 +1,71 @@
+import sqlite3
+
+# * Records every object version which has been fully written, so checking if an
+# * object needs to be downloaded is one indexed lookup instead of several stats
+class Manifest:
+	def __init__(self, path: str):
+		self.conn = sqlite3.connect(path, timeout=60) # * Other processes only hold the database for a moment
+
+		# * Other processes can have the database open too. With WAL, reads never wait
+		# * for a writer and a commit is an append instead of rewriting pages
+		self.conn.execute('PRAGMA journal_mode = WAL')
+
+		self.conn.execute('''
+			CREATE TABLE IF NOT EXISTS manifest (
+				data_id INTEGER NOT NULL,
+				version INTEGER NOT NULL,
+				size INTEGER NOT NULL,
+				checksum TEXT NOT NULL,
+				sidecars TEXT NOT NULL,
+				PRIMARY KEY (data_id, version)
+			)
+		''')
+		self.conn.commit()
+
+	def is_complete(self, data_id: int, version: int, expected_size: int | None, sidecars: list[str]) -> bool:
+		# * expected_size can be None when the size is not known yet
+		row = self.conn.execute('SELECT size, sidecars FROM manifest WHERE data_id = ? AND version = ?', (data_id, version)).fetchone()
+
+		if row is None:
+			return False
+
+		size, written_sidecars = row
+
+		if expected_size is not None and size != expected_size:
+			return False
+
+		written_sidecars = written_sidecars.split(',')
+
+		return all(sidecar in written_sidecars for sidecar in sidecars)
+
+	def checksum(self, data_id: int, version: int) -> str | None:
+		row = self.conn.execute('SELECT checksum FROM manifest WHERE data_id = ? AND version = ?', (data_id, version)).fetchone()
+
+		return None if row is None else row[0]
+
+	def record(self, data_id: int, version: int, size: int, checksum: str, sidecars: list[str]):
+		self.conn.execute('INSERT OR REPLACE INTO manifest (data_id, version, size, checksum, sidecars) VALUES (?, ?, ?, ?, ?)', (data_id, version, size, checksum, ','.join(sidecars)))
+
+	def record_many(self, rows: list[tuple[int, int, int, str, list[str]]]):
+		self.conn.executemany('INSERT OR REPLACE INTO manifest (data_id, version, size, checksum, sidecars) VALUES (?, ?, ?, ?, ?)', [
+			(data_id, version, size, checksum, ','.join(sidecars))
+			for data_id, version, size, checksum, sidecars in rows
+		])
+
+	def entries(self):
+		# * Every recorded object version as (data_id, version, size, checksum, sidecars), in data ID order
+		rows = self.conn.execute('SELECT data_id, version, size, checksum, sidecars FROM manifest ORDER BY data_id, version')
+
+		for data_id, version, size, checksum, sidecars in rows:
+			yield data_id, version, size, checksum, sidecars.split(',') if sidecars else []
+
+	def remove_many(self, keys: list[tuple[int, int]]):
+		# * Removed versions are downloaded again the next time they are seen
+		self.conn.executemany('DELETE FROM manifest WHERE data_id = ? AND version = ?', keys)
+
+	def commit(self):
+		self.conn.commit()
+
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
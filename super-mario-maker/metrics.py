@@ -0,0 +1,181 @@
+import os
+import time
+import anyio
+import threading
+import contextlib
+
+# * Default histogram buckets, in seconds
+LATENCY_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30 ]
+
+# * Counters, gauges and histograms kept in memory and rendered in the
+# * Prometheus text format. Updating a metric is a dict lookup, so they
+# * are always collected, and only exported if an exporter is started.
+# * Safe to update from writer threads
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.types = {}
+		self.help = {}
+		self.buckets = {}
+		self.values = {}
+		self.callbacks = {}
+
+	def counter(self, name: str, help: str):
+		self.types[name] = 'counter'
+		self.help[name] = help
+		self.values.setdefault(name, {})
+
+	def gauge(self, name: str, help: str, func=None):
+		# * func is called every time metrics are rendered, for values like queue depths
+		self.types[name] = 'gauge'
+		self.help[name] = help
+		self.values.setdefault(name, {})
+
+		if func is not None:
+			self.callbacks[name] = func
+
+	def histogram(self, name: str, help: str, buckets: list[float] = LATENCY_BUCKETS):
+		self.types[name] = 'histogram'
+		self.help[name] = help
+		self.buckets[name] = buckets
+		self.values.setdefault(name, {})
+
+	def inc(self, name: str, amount: float = 1, **labels):
+		key = tuple(sorted(labels.items()))
+
+		with self.lock:
+			self.values[name][key] = self.values[name].get(key, 0) + amount
+
+	def set(self, name: str, value: float, **labels):
+		key = tuple(sorted(labels.items()))
+
+		with self.lock:
+			self.values[name][key] = value
+
+	def observe(self, name: str, value: float, **labels):
+		key = tuple(sorted(labels.items()))
+
+		with self.lock:
+			if key not in self.values[name]:
+				# * One count per bucket, then the sum and count of all observations
+				self.values[name][key] = [0] * (len(self.buckets[name]) + 2)
+
+			counts = self.values[name][key]
+
+			for i, bound in enumerate(self.buckets[name]):
+				if value <= bound:
+					counts[i] += 1
+
+			counts[-2] += value
+			counts[-1] += 1
+
+	@contextlib.contextmanager
+	def time(self, name: str, **labels):
+		# * Works around awaits too, the time spent waiting is what is measured
+		start = time.monotonic()
+
+		try:
+			yield
+		finally:
+			self.observe(name, time.monotonic() - start, **labels)
+
+	def render(self) -> str:
+		lines = []
+
+		for name, func in self.callbacks.items():
+			self.set(name, func())
+
+		with self.lock:
+			for name, metric_type in self.types.items():
+				lines.append('# HELP %s %s' % (name, self.help[name]))
+				lines.append('# TYPE %s %s' % (name, metric_type))
+
+				for key, value in self.values[name].items():
+					if metric_type != 'histogram':
+						lines.append('%s%s %s' % (name, format_labels(key), format_value(value)))
+						continue
+
+					for bound, count in zip(self.buckets[name], value):
+						lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', format_value(bound)),)), count))
+
+					lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', '+Inf'),)), value[-1]))
+					lines.append('%s_sum%s %s' % (name, format_labels(key), format_value(value[-2])))
+					lines.append('%s_count%s %d' % (name, format_labels(key), value[-1]))
+
+		return '\n'.join(lines) + '\n'
+
+def format_labels(key: tuple) -> str:
+	if not key:
+		return ''
+
+	labels = ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in key)
+
+	return '{%s}' % labels
+
+def format_value(value: float) -> str:
+	if isinstance(value, int) or float(value).is_integer():
+		return str(int(value))
+
+	return repr(float(value))
+
+def write_metrics_file(metrics: Metrics, path: str):
+	# * Written to a temp file first, so readers never see a half written file
+	temp_path = path + '.tmp'
+
+	with open(temp_path, 'w') as metrics_file:
+		metrics_file.write(metrics.render())
+
+	os.replace(temp_path, path)
+
+async def serve_metrics_client(metrics: Metrics, client):
+	async with client:
+		request = b''
+
+		try:
+			while b'\r\n\r\n' not in request and len(request) < 8192:
+				request += await client.receive()
+		except (anyio.EndOfStream, anyio.BrokenResourceError):
+			return
+
+		body = metrics.render().encode('utf-8')
+		head = 'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % len(body)
+
+		try:
+			await client.send(head.encode('latin-1') + body)
+		except anyio.BrokenResourceError:
+			pass
+
+async def serve_metrics(metrics: Metrics, port: int):
+	listener = await anyio.create_tcp_listener(local_host='127.0.0.1', local_port=port)
+
+	print("Serving metrics on http://127.0.0.1:%d/metrics" % port)
+
+	await listener.serve(lambda client: serve_metrics_client(metrics, client))
+
+async def write_metrics_periodically(metrics: Metrics, path: str, interval: float):
+	while True:
+		await anyio.sleep(interval)
+		await anyio.to_thread.run_sync(write_metrics_file, metrics, path)
+
+# * Serves metrics over HTTP on "port" and/or writes them to "path" every "interval"
+# * seconds, in the format read by the Prometheus node exporter textfile collector.
+# * Does nothing if neither is set
+@contextlib.asynccontextmanager
+async def start_metrics_exporter(metrics: Metrics, port: int = 0, path: str = '', interval: float = 15):
+	async with anyio.create_task_group() as tg:
+		if port:
+			tg.start_soon(serve_metrics, metrics, port)
+
+		if path:
+			tg.start_soon(write_metrics_periodically, metrics, path, interval)
+
+		try:
+			yield metrics
+		finally:
+			tg.cancel_scope.cancel()
+
+			if path:
+				# * Keep the final numbers from the run
+				write_metrics_file(metrics, path)
+
+metrics = Metrics()
@@ -0,0 +1,68 @@
+import anyio
+import contextlib
+from metrics import metrics
+
+metrics.gauge('pipeline_queue_depth', 'Items waiting for each pipeline stage')
+metrics.histogram('pipeline_stage_seconds', 'Time taken by each pipeline stage for one item')
+metrics.counter('pipeline_errors_total', 'Items dropped because a pipeline stage failed, by stage')
+
+class PipelineStage:
+	def __init__(self, name: str, func, workers: int):
+		# * func takes an item and returns the item to pass to the next stage, or None to drop it
+		self.name = name
+		self.func = func
+		self.workers = workers
+
+async def run_stage_worker(stage: PipelineStage, receive_stream, send_stream, on_error):
+	async with receive_stream:
+		async for item in receive_stream:
+			metrics.set('pipeline_queue_depth', receive_stream.statistics().current_buffer_used, stage=stage.name)
+
+			try:
+				with metrics.time('pipeline_stage_seconds', stage=stage.name):
+					item = await stage.func(item)
+			except Exception as e:
+				# * One item failing does not stop the others
+				metrics.inc('pipeline_errors_total', stage=stage.name)
+				on_error(stage, item, e)
+				continue
+
+			if item is not None and send_stream is not None:
+				await send_stream.send(item)
+
+	# * The next stage ends once every worker of this one has closed it's stream
+	if send_stream is not None:
+		await send_stream.aclose()
+
+# * Passes items through a chain of stages, each with it's own number of
+# * workers and a bounded queue in front of it. Every stage works all the
+# * time rather than waiting for a whole batch, and a slow stage makes the
+# * stages before it wait instead of letting items pile up in memory.
+# * Items are sent to the stream this yields. On exit, everything already
+# * sent goes through every stage before this returns. If a stage raises an
+# * exception, on_error is called with the stage, item and exception, and the
+# * item is dropped
+@contextlib.asynccontextmanager
+async def start_pipeline(stages: list[PipelineStage], queue_size: int, on_error):
+	streams = [anyio.create_memory_object_stream(queue_size) for stage in stages]
+
+	async with anyio.create_task_group() as tg:
+		for i, stage in enumerate(stages):
+			receive_stream = streams[i][1]
+			send_stream = streams[i + 1][0] if i + 1 < len(stages) else None
+
+			for j in range(stage.workers):
+				tg.start_soon(run_stage_worker, stage, receive_stream.clone(), send_stream.clone() if send_stream is not None else None, on_error)
+
+			# * Only the workers clones are kept open
+			receive_stream.close()
+
+			if send_stream is not None:
+				send_stream.close()
+
+		input_stream = streams[0][0]
+
+		try:
+			yield input_stream
+		finally:
+			input_stream.close()
@@ -0,0 +1,62 @@
+import os
+import json
+import random
+from metrics import metrics
+
+MIN_SAMPLES = 200 # * Never skip a probe until it has failed this many times in a row for a data type
+
+metrics.counter('smm_probes_total', 'Probes by result (hit, miss or skipped)')
+
+# * Tracks which probes (buffer queue slots, custom ranking application IDs and
+# * course record slots) succeed for each object data_type. Probes which have
+# * never succeeded for a data_type are skipped, except for a small random
+# * sample which is still sent so nothing is lost if the data does exist
+class ProbePlanner:
+	def __init__(self, path: str, enabled: bool = True, audit_rate: float = 0.01):
+		self.path = path
+		self.enabled = enabled
+		self.audit_rate = audit_rate
+		self.stats = {}
+
+		if os.path.isfile(path):
+			with open(path, 'r') as stats_file:
+				self.stats = json.load(stats_file)
+
+	def key(self, data_type: int, probe: str) -> str:
+		return '%d:%s' % (data_type, probe)
+
+	def should_probe(self, data_type: int, probe: str) -> bool:
+		if not self.enabled:
+			return True
+
+		hits, misses = self.stats.get(self.key(data_type, probe), [0, 0])
+
+		if hits > 0 or misses < MIN_SAMPLES:
+			return True
+
+		# * Audit skipped probes every so often in case they start hitting
+		if random.random() < self.audit_rate:
+			return True
+
+		metrics.inc('smm_probes_total', probe=probe, result='skipped')
+
+		return False
+
+	def record(self, data_type: int, probe: str, hit: bool):
+		stats = self.stats.setdefault(self.key(data_type, probe), [0, 0])
+
+		metrics.inc('smm_probes_total', probe=probe, result='hit' if hit else 'miss')
+
+		if hit:
+			stats[0] += 1
+		else:
+			stats[1] += 1
+
+	def save(self):
+		# * Write to a temp file first so a crash never leaves a half written file
+		temp_path = self.path + '.tmp'
+
+		with open(temp_path, 'w') as stats_file:
+			json.dump(self.stats, stats_file)
+
+		os.replace(temp_path, self.path)
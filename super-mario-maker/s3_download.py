@@ -0,0 +1,382 @@
+import os
+import time
+import anyio
+import hashlib
+import contextlib
+from anynet import tls, util
+from metrics import metrics
+
+RECV_SIZE = 65536
+FLUSH_SIZE = 1024 * 1024 # * Buffer this much before writing to disk
+MAX_ATTEMPTS = 3 # * Times a request is sent before giving up, if S3 keeps failing
+RETRY_DELAY = 1 # * Seconds to wait before sending a request again after S3 failed
+
+class S3DownloadError(Exception):
+	def __init__(self, message: str, status_code: int | None = None):
+		super().__init__(message)
+		self.status_code = status_code # * Set if S3 answered with an error status
+
+	def is_transient(self) -> bool:
+		# * 5xx means S3 failed, such as 503 Slow Down, and may work if sent again
+		return self.status_code is not None and self.status_code >= 500
+
+metrics.counter('s3_bytes_total', 'Object bytes received from S3')
+metrics.counter('s3_downloads_total', 'Objects downloaded from S3, by result')
+metrics.counter('s3_connections_total', 'Connections used for S3 requests, by if they were reused')
+metrics.histogram('s3_download_seconds', 'Time taken to download each object')
+
+# * Limits how many bytes of object data can be downloading at once. Every
+# * download reserves its expected size before it starts, and waits for
+# * other downloads to finish if the budget is used up
+class ByteBudget:
+	def __init__(self, limit: int):
+		self.limit = limit
+		self.in_flight = 0
+		self.condition = anyio.Condition()
+
+	async def acquire(self, size: int) -> int:
+		# * Objects bigger than the whole budget still get to download, on their own
+		size = min(size, self.limit)
+
+		async with self.condition:
+			while self.in_flight + size > self.limit:
+				await self.condition.wait()
+
+			self.in_flight += size
+
+		return size
+
+	async def release(self, size: int):
+		async with self.condition:
+			self.in_flight -= size
+			self.condition.notify_all()
+
+# * anynet keeps the whole response body in memory, even when streaming
+# * it with writefunc. This reads the response itself so only one chunk
+# * is ever held at a time
+class HTTPResponseReader:
+	def __init__(self, client):
+		self.client = client
+		self.buffer = b''
+		self.received = 0 # * Bytes received for the current response
+
+	async def fill(self):
+		try:
+			data = await self.client.recv(RECV_SIZE)
+		except util.StreamError:
+			data = b''
+
+		if not data:
+			raise S3DownloadError('Connection closed before the response was complete')
+
+		self.received += len(data)
+		self.buffer += data
+
+	async def read_until(self, separator: bytes) -> bytes:
+		while separator not in self.buffer:
+			await self.fill()
+
+		data, self.buffer = self.buffer.split(separator, 1)
+
+		return data
+
+	async def read_head(self) -> tuple[int, dict]:
+		head = (await self.read_until(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+		status_code = int(head[0].split(' ', 2)[1])
+		headers = {}
+
+		for line in head[1:]:
+			key, value = line.split(':', 1)
+			headers[key.strip().lower()] = value.strip()
+
+		return status_code, headers
+
+	async def read_body(self, length: int, writefunc):
+		remaining = length
+
+		while remaining > 0:
+			if not self.buffer:
+				await self.fill()
+
+			chunk = self.buffer[:remaining]
+			self.buffer = self.buffer[len(chunk):]
+			remaining -= len(chunk)
+
+			await writefunc(chunk)
+
+	async def read_chunked_body(self, writefunc):
+		while True:
+			chunk_size = int((await self.read_until(b'\r\n')).split(b';')[0], 16)
+
+			if chunk_size == 0:
+				await self.read_until(b'\r\n') # * Skip the (empty) trailer
+				return
+
+			await self.read_body(chunk_size, writefunc)
+			await self.read_until(b'\r\n')
+
+	async def read_until_closed(self, writefunc):
+		if self.buffer:
+			await writefunc(self.buffer)
+			self.buffer = b''
+
+		while True:
+			try:
+				data = await self.client.recv(RECV_SIZE)
+			except util.StreamError:
+				return
+
+			if not data:
+				return
+
+			await writefunc(data)
+
+# * A connection which can be used for more than one request
+class PooledConnection:
+	def __init__(self, key: tuple, client):
+		self.key = key
+		self.client = client
+		self.reader = HTTPResponseReader(client)
+		self.reused = False
+		self.last_used = time.monotonic()
+
+	async def close(self):
+		with anyio.CancelScope(shield=True):
+			try:
+				await self.client.close()
+			except Exception:
+				pass
+
+# * Keeps connections to S3 open between downloads, so each object does not
+# * need a new TCP and TLS handshake. Limits the number of connections open
+# * in total and to each host, and closes connections which sit idle too long
+class ConnectionPool:
+	def __init__(self, max_connections: int, max_connections_per_host: int, idle_timeout: float):
+		self.max_connections = max_connections
+		self.max_connections_per_host = max_connections_per_host
+		self.idle_timeout = idle_timeout
+		self.limiter = anyio.CapacityLimiter(max_connections)
+		self.host_limiters = {}
+		self.idle = {}
+		self.ssl_context = tls.TLSContext().get(False)
+
+	def host_limiter(self, key: tuple) -> anyio.CapacityLimiter:
+		if key not in self.host_limiters:
+			self.host_limiters[key] = anyio.CapacityLimiter(self.max_connections_per_host)
+
+		return self.host_limiters[key]
+
+	async def connect(self, key: tuple) -> PooledConnection:
+		scheme, host, port = key
+		ssl_context = self.ssl_context if scheme == 'https' else None
+		stream = await anyio.connect_tcp(host, port, ssl_context=ssl_context, tls_standard_compatible=False)
+
+		return PooledConnection(key, tls.TLSClient(stream))
+
+	async def acquire(self, key: tuple) -> PooledConnection:
+		await self.limiter.acquire()
+
+		try:
+			await self.host_limiter(key).acquire()
+
+			try:
+				await self.evict()
+
+				idle = self.idle.get(key)
+
+				if idle:
+					connection = idle.pop()
+					connection.reused = True
+				else:
+					connection = await self.connect(key)
+
+				metrics.inc('s3_connections_total', reused=str(connection.reused).lower())
+
+				connection.reader.received = 0
+
+				return connection
+			except BaseException:
+				self.host_limiter(key).release()
+				raise
+		except BaseException:
+			self.limiter.release()
+			raise
+
+	async def release(self, connection: PooledConnection, reusable: bool):
+		try:
+			if reusable:
+				connection.last_used = time.monotonic()
+				self.idle.setdefault(connection.key, []).append(connection)
+			else:
+				await connection.close()
+
+			await self.evict()
+		finally:
+			self.host_limiter(connection.key).release()
+			self.limiter.release()
+
+	async def evict(self):
+		now = time.monotonic()
+		idle = []
+
+		for key in list(self.idle.keys()):
+			for connection in self.idle[key]:
+				if now - connection.last_used > self.idle_timeout:
+					await connection.close()
+				else:
+					idle.append(connection)
+
+		# * Close the longest idle connections if there are too many
+		idle.sort(key=lambda connection: connection.last_used, reverse=True)
+
+		for connection in idle[self.max_connections:]:
+			await connection.close()
+
+		self.idle = {}
+
+		for connection in idle[:self.max_connections]:
+			self.idle.setdefault(connection.key, []).append(connection)
+
+	async def close(self):
+		for connections in self.idle.values():
+			for connection in connections:
+				await connection.close()
+
+		self.idle = {}
+
+@contextlib.asynccontextmanager
+async def create_connection_pool(max_connections: int, max_connections_per_host: int, idle_timeout: float):
+	pool = ConnectionPool(max_connections, max_connections_per_host, idle_timeout)
+
+	try:
+		yield pool
+	finally:
+		with anyio.CancelScope(shield=True):
+			await pool.close()
+
+def build_request(url: str, headers: dict, keep_alive: bool) -> tuple[tuple, bytes]:
+	scheme, host, port, path = util.parse_url(url)
+
+	if port is None:
+		port = 443 if scheme == 'https' else 80
+
+	lines = ['GET %s HTTP/1.1' % (path or '/'), 'Host: %s' % host]
+	lines += ['%s: %s' % (key, value) for key, value in headers.items() if key.lower() != 'host']
+	lines += ['Connection: %s' % ('keep-alive' if keep_alive else 'close'), '', '']
+
+	return (scheme, host, port), '\r\n'.join(lines).encode('latin-1')
+
+# * Reads one response. Returns True if the connection can be used for another request
+async def read_response(reader: HTTPResponseReader, url: str, writefunc) -> bool:
+	status_code, response_headers = await reader.read_head()
+
+	if status_code < 200 or status_code >= 300:
+		raise S3DownloadError('S3 returned HTTP %d for %s' % (status_code, url), status_code)
+
+	if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+		await reader.read_chunked_body(writefunc)
+	elif 'content-length' in response_headers:
+		await reader.read_body(int(response_headers['content-length']), writefunc)
+	else:
+		await reader.read_until_closed(writefunc)
+		return False
+
+	return response_headers.get('connection', '').lower() != 'close'
+
+async def stream_get(url: str, headers: dict, writefunc, pool: ConnectionPool | None = None):
+	# * The status is read before any of the body is passed to writefunc,
+	# * so requests which S3 failed can be sent again
+	for attempt in range(MAX_ATTEMPTS):
+		try:
+			await stream_get_once(url, headers, writefunc, pool)
+			return
+		except S3DownloadError as e:
+			if not e.is_transient() or attempt == MAX_ATTEMPTS - 1:
+				raise
+
+		await anyio.sleep(RETRY_DELAY)
+
+async def stream_get_once(url: str, headers: dict, writefunc, pool: ConnectionPool | None = None):
+	if pool is None:
+		(scheme, host, port), request = build_request(url, headers, False)
+		context = tls.TLSContext() if scheme == 'https' else None
+
+		async with tls.connect(host, port, context) as client:
+			await client.send(request)
+			await read_response(HTTPResponseReader(client), url, writefunc)
+
+		return
+
+	key, request = build_request(url, headers, True)
+
+	while True:
+		connection = await pool.acquire(key)
+		reusable = False
+
+		try:
+			await connection.client.send(request)
+			reusable = await read_response(connection.reader, url, writefunc)
+			return
+		except (S3DownloadError, *util.StreamError) as e:
+			# * The server may have closed an idle connection just as it was reused.
+			# * If nothing was received, try again on a new connection
+			if connection.reused and connection.reader.received == 0:
+				continue
+
+			if isinstance(e, S3DownloadError):
+				raise
+
+			raise S3DownloadError('Connection to %s failed' % url) from e
+		finally:
+			await pool.release(connection, reusable)
+
+# * Streams an object to "path". The data is written to a temp file which is
+# * only renamed into place once the whole object was downloaded and matches
+# * the expected size. Returns the SHA-256 of the object
+async def download_object(url: str, headers: dict, path: str, expected_size: int, budget: ByteBudget | None = None, pool: ConnectionPool | None = None, opener=open) -> str:
+	temp_path = path + '.part'
+	sha256 = hashlib.sha256()
+	pending = bytearray()
+	size = 0
+
+	reserved = await budget.acquire(expected_size) if budget is not None else 0
+
+	try:
+		with opener(temp_path, 'wb') as output_file:
+			async def writefunc(chunk: bytes):
+				nonlocal size, pending
+
+				sha256.update(chunk)
+				size += len(chunk)
+				metrics.inc('s3_bytes_total', len(chunk))
+				pending += chunk
+
+				if len(pending) >= FLUSH_SIZE:
+					data, pending = bytes(pending), bytearray()
+					await anyio.to_thread.run_sync(output_file.write, data)
+
+			with metrics.time('s3_download_seconds'):
+				await stream_get(url, headers, writefunc, pool)
+
+			if pending:
+				await anyio.to_thread.run_sync(output_file.write, bytes(pending))
+
+		if size != expected_size:
+			raise S3DownloadError('Expected %d bytes from %s, got %d' % (expected_size, url, size))
+
+		os.replace(temp_path, path)
+	except BaseException:
+		metrics.inc('s3_downloads_total', result='failed')
+
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+
+		raise
+	finally:
+		if budget is not None:
+			with anyio.CancelScope(shield=True):
+				await budget.release(reserved)
+
+	metrics.inc('s3_downloads_total', result='downloaded')
+
+	return sha256.hexdigest()
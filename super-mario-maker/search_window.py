@@ -0,0 +1,83 @@
+import os
+import json
+
+DAY_SECONDS = 86400
+MIN_WINDOW_SECONDS = 60 # * 1 minute
+MAX_WINDOW_SECONDS = DAY_SECONDS * 30 # * 30 days
+MAX_GROWTH = 4 # * Never grow a window by more than this much at once, since density is only a guess
+TARGET_FILL = 0.75 # * Aim for windows which fill 75% of a search page
+
+# * Objects-per-second seen on each day of the timeline. Saved
+# * between runs so later scans start with a good window size
+class SearchWindowDensity:
+	def __init__(self, path: str):
+		self.path = path
+		self.densities = {}
+
+		if os.path.isfile(path):
+			with open(path, 'r') as density_file:
+				self.densities = {int(day): density for day, density in json.load(density_file).items()}
+
+	def get(self, seconds: int) -> float | None:
+		return self.densities.get(seconds // DAY_SECONDS)
+
+	def record(self, start_seconds: int, end_seconds: int, density: float):
+		for day in range(start_seconds // DAY_SECONDS, (end_seconds // DAY_SECONDS) + 1):
+			if day in self.densities:
+				# * Busy days are searched in many windows, smooth them out
+				self.densities[day] = (self.densities[day] + density) / 2
+			else:
+				self.densities[day] = density
+
+	def save(self):
+		# * Write to a temp file first so a crash never leaves a half written file
+		temp_path = self.path + '.tmp'
+
+		with open(temp_path, 'w') as density_file:
+			json.dump({str(day): density for day, density in sorted(self.densities.items())}, density_file)
+
+		os.replace(temp_path, self.path)
+
+# * Picks the size of the next search window. Windows which fill
+# * a whole search page shrink, and sparse windows grow
+class SearchWindowSizer:
+	def __init__(self, density: SearchWindowDensity, page_size: int, initial_window_seconds: int, adaptive: bool = True):
+		self.density = density
+		self.page_size = page_size
+		self.window_seconds = initial_window_seconds
+		self.adaptive = adaptive
+
+	def size_for_density(self, density: float, max_window_seconds: int) -> int:
+		if density <= 0:
+			window_seconds = max_window_seconds
+		else:
+			window_seconds = int((self.page_size * TARGET_FILL) / density)
+
+		return max(MIN_WINDOW_SECONDS, min(window_seconds, max_window_seconds, MAX_WINDOW_SECONDS))
+
+	def next_window(self, start_seconds: int) -> int:
+		if not self.adaptive:
+			return self.window_seconds
+
+		recorded_density = self.density.get(start_seconds)
+
+		if recorded_density is not None and recorded_density > 0:
+			# * Trust densities seen in previous windows/runs over the running guess
+			self.window_seconds = self.size_for_density(recorded_density, MAX_WINDOW_SECONDS)
+
+		return self.window_seconds
+
+	def update(self, start_seconds: int, end_seconds: int, object_count: int, last_object_seconds: int):
+		if not self.adaptive:
+			return
+
+		if object_count >= self.page_size:
+			# * Full page, the window was only searched up to the last object returned
+			covered_seconds = max(last_object_seconds - start_seconds, 1)
+		else:
+			covered_seconds = max(end_seconds - start_seconds, 1)
+
+		density = object_count / covered_seconds
+
+		self.density.record(start_seconds, start_seconds + covered_seconds, density)
+		self.window_seconds = self.size_for_density(density, self.window_seconds * MAX_GROWTH)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import struct
+import sqlite3
+import threading
+
+# * Each record is a header followed by the record data. The header repeats
+# * everything in the index, so the index can be rebuilt from the segments
+# * (apart from deduplicated objects, which point at an earlier record)
+# *
+# * magic (4 bytes), data ID (u64), version (u32), kind length (u8), kind, data length (u64)
+RECORD_MAGIC = b'SMMR'
+RECORD_HEADER = struct.Struct('>4sQIB')
+RECORD_LENGTH = struct.Struct('>Q')
+COPY_SIZE = 1024 * 1024
+
+# * Appends objects and their sidecars to large rolling segment files instead of
+# * writing millions of small files. Writes are always sequential, and where each
+# * record lives is kept in an SQLite index next to the segments. Safe to use
+# * from several writer threads at once
+class SegmentStore:
+	def __init__(self, path: str, max_segment_size: int):
+		self.path = path
+		self.max_segment_size = max_segment_size
+		self.lock = threading.Lock()
+
+		os.makedirs(path, exist_ok=True)
+
+		self.conn = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False)
+		self.conn.execute('''
+			CREATE TABLE IF NOT EXISTS records (
+				data_id INTEGER NOT NULL,
+				version INTEGER NOT NULL,
+				kind TEXT NOT NULL,
+				segment INTEGER NOT NULL,
+				offset INTEGER NOT NULL,
+				length INTEGER NOT NULL,
+				PRIMARY KEY (data_id, version, kind)
+			)
+		''')
+		# * Where each distinct object payload was first written, so identical payloads are only stored once
+		self.conn.execute('''
+			CREATE TABLE IF NOT EXISTS blobs (
+				checksum TEXT PRIMARY KEY,
+				segment INTEGER NOT NULL,
+				offset INTEGER NOT NULL,
+				length INTEGER NOT NULL
+			)
+		''')
+		self.conn.commit()
+
+		# * Always start a new segment, so nothing is appended after a
+		# * record which may have been cut off by a crash
+		row = self.conn.execute('SELECT MAX(segment) FROM records').fetchone()
+		self.segment = 0 if row[0] is None else row[0] + 1
+
+		while os.path.exists(self.segment_path(self.segment)):
+			self.segment += 1
+
+		self.segment_file = None # * Opened on the first append, so runs which write nothing leave no empty segments
+
+	def segment_path(self, segment: int) -> str:
+		return os.path.join(self.path, 'segment-%05d.bin' % segment)
+
+	def roll(self):
+		self.sync()
+		self.segment_file.close()
+
+		self.segment += 1
+		self.segment_file = open(self.segment_path(self.segment), 'ab')
+
+	def write_header(self, data_id: int, version: int, kind: str, length: int) -> int:
+		if self.segment_file is None:
+			self.segment_file = open(self.segment_path(self.segment), 'ab')
+		elif self.segment_file.tell() >= self.max_segment_size:
+			self.roll()
+
+		kind_bytes = kind.encode('utf-8')
+
+		self.segment_file.write(RECORD_HEADER.pack(RECORD_MAGIC, data_id, version, len(kind_bytes)))
+		self.segment_file.write(kind_bytes)
+		self.segment_file.write(RECORD_LENGTH.pack(length))
+
+		return self.segment_file.tell()
+
+	def index(self, data_id: int, version: int, kind: str, offset: int, length: int, segment: int | None = None):
+		segment = self.segment if segment is None else segment
+
+		self.conn.execute('INSERT OR REPLACE INTO records (data_id, version, kind, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?)', (data_id, version, kind, segment, offset, length))
+
+	def append(self, data_id: int, version: int, kind: str, data: bytes):
+		with self.lock:
+			offset = self.write_header(data_id, version, kind, len(data))
+			self.segment_file.write(data)
+			self.index(data_id, version, kind, offset, len(data))
+
+	def append_file(self, data_id: int, version: int, kind: str, path: str, checksum: str | None = None):
+		# * Copies a file into the segment without reading it all into memory.
+		# * If a file with the same checksum was already stored, the record
+		# * points at that copy instead. Records stored this way have no header
+		# * of their own, so only the index knows about them
+		length = os.path.getsize(path)
+
+		with open(path, 'rb') as input_file, self.lock:
+			if checksum is not None:
+				row = self.conn.execute('SELECT segment, offset, length FROM blobs WHERE checksum = ?', (checksum,)).fetchone()
+
+				if row is not None and row[2] == length:
+					self.index(data_id, version, kind, row[1], length, row[0])
+					return
+
+			offset = self.write_header(data_id, version, kind, length)
+			shutil.copyfileobj(input_file, self.segment_file, COPY_SIZE)
+			self.index(data_id, version, kind, offset, length)
+
+			if checksum is not None:
+				self.conn.execute('INSERT OR REPLACE INTO blobs (checksum, segment, offset, length) VALUES (?, ?, ?, ?)', (checksum, self.segment, offset, length))
+
+	def read(self, data_id: int, version: int, kind: str) -> bytes | None:
+		with self.lock:
+			row = self.conn.execute('SELECT segment, offset, length FROM records WHERE data_id = ? AND version = ? AND kind = ?', (data_id, version, kind)).fetchone()
+
+			if row is None:
+				return None
+
+			segment, offset, length = row
+
+			if segment == self.segment and self.segment_file is not None:
+				self.segment_file.flush()
+
+		with open(self.segment_path(segment), 'rb') as segment_file:
+			segment_file.seek(offset)
+			return segment_file.read(length)
+
+	def records(self):
+		return self.conn.execute('SELECT data_id, version, kind FROM records ORDER BY segment, offset')
+
+	def sync(self):
+		if self.segment_file is None:
+			return
+
+		self.segment_file.flush()
+		os.fsync(self.segment_file.fileno())
+
+	def commit(self):
+		# * Data must be on disk before the index points at it
+		with self.lock:
+			self.sync()
+			self.conn.commit()
+
+	def close(self):
+		self.commit()
+		self.conn.close()
+
+		if self.segment_file is not None:
+			self.segment_file.close()
@@ -0,0 +1,159 @@
+import anyio
+import contextlib
+from nintendo.nex import backend, common, datastore_smm
+from metrics import metrics
+
+RECONNECT_DELAY = 5 # * Seconds to wait before replacing a session which died
+MAX_ATTEMPTS = 3 # * Times a request is sent before giving up, if sessions keep dying or the server keeps failing
+RETRY_DELAY = 1 # * Seconds to wait before sending a request again after a transient error
+MAX_LOGIN_FAILURES = 5 # * Failed logins in a row before a session stops trying
+
+# * Errors which say the server failed, rather than anything about the request
+TRANSIENT_RMC_ERRORS = [ 'Core::SystemError', 'Core::Timeout', 'Core::OperationAborted', 'RendezVous::DatabaseTemporarilyUnavailable' ]
+
+# * Errors which mean the connection behind a session is broken
+CONNECTION_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, ConnectionError, TimeoutError)
+
+class NoSessionsError(Exception):
+	pass
+
+metrics.histogram('nex_rpc_seconds', 'Time taken by each NEX request, by method')
+metrics.counter('nex_rpc_errors_total', 'NEX requests which failed, by method and error')
+metrics.counter('nex_session_logins_total', 'NEX sessions logged in, including replacements for sessions which died')
+
+class Session:
+	def __init__(self, index: int, username: str, password: str):
+		self.index = index
+		self.username = username
+		self.password = password
+		self.client = None
+		self.in_flight = 0
+		self.dead = None
+		self.login_failures = 0 # * Failed logins since the last one which worked
+
+# * Keeps several NEX sessions logged in at once, possibly with different
+# * accounts, and spreads requests over them. Sessions which die are
+# * logged in again in the background
+class SessionPool:
+	def __init__(self, settings, host: str, port: int, credentials: list[tuple[str, str]], sessions_per_account: int):
+		self.settings = settings
+		self.host = host
+		self.port = port
+		self.sessions = []
+		self.live = []
+		self.changed = anyio.Event()
+
+		metrics.gauge('nex_sessions_live', 'NEX sessions currently logged in', lambda: len(self.live))
+
+		for username, password in credentials:
+			for i in range(sessions_per_account):
+				self.sessions.append(Session(len(self.sessions), username, password))
+
+	def notify(self):
+		self.changed.set()
+		self.changed = anyio.Event()
+
+	async def maintain(self, session: Session):
+		while session.login_failures < MAX_LOGIN_FAILURES:
+			logged_in = False
+
+			try:
+				async with backend.connect(self.settings, self.host, self.port) as be:
+					async with be.login(session.username, session.password) as client:
+						logged_in = True
+						session.login_failures = 0
+						session.client = datastore_smm.DataStoreClientSMM(client)
+						session.dead = anyio.Event()
+
+						self.live.append(session)
+						self.notify()
+
+						metrics.inc('nex_session_logins_total')
+
+						print("[Session %d] Logged in as %s" % (session.index, session.username))
+
+						await session.dead.wait()
+			except Exception as e:
+				print("[Session %d] Session died: %s" % (session.index, repr(e)))
+			finally:
+				if session in self.live:
+					self.live.remove(session)
+
+				session.client = None
+
+			if not logged_in:
+				session.login_failures += 1
+
+			await anyio.sleep(RECONNECT_DELAY)
+
+		print("[Session %d] Giving up after %d failed logins in a row" % (session.index, session.login_failures))
+
+		# * Wakes up anything waiting in acquire, in case this was the last session
+		self.notify()
+
+	def is_connection_error(self, session: Session, e: Exception) -> bool:
+		if isinstance(e, CONNECTION_ERRORS):
+			return True
+
+		# * NintendoClients raises RuntimeError for requests on, or waiting on, a closed connection
+		return isinstance(e, RuntimeError) and (session.client is None or session.client.client.closed)
+
+	async def acquire(self) -> Session:
+		while not self.live:
+			if all(session.login_failures >= MAX_LOGIN_FAILURES for session in self.sessions):
+				raise NoSessionsError('Every NEX session failed to log in %d times in a row' % MAX_LOGIN_FAILURES)
+
+			await self.changed.wait()
+
+		# * Send to whichever session is the least busy
+		return min(self.live, key=lambda session: session.in_flight)
+
+	async def call(self, func, *args):
+		# * func is called with a DataStoreClientSMM as it's first argument
+		for attempt in range(MAX_ATTEMPTS):
+			session = await self.acquire()
+			session.in_flight += 1
+
+			try:
+				with metrics.time('nex_rpc_seconds', method=func.__name__):
+					return await func(session.client, *args)
+			except common.RMCError as e:
+				# * The server answered, so the session is fine
+				metrics.inc('nex_rpc_errors_total', method=func.__name__, error=e.name())
+
+				if e.name() not in TRANSIENT_RMC_ERRORS or attempt == MAX_ATTEMPTS - 1:
+					raise
+			except Exception as e:
+				metrics.inc('nex_rpc_errors_total', method=func.__name__, error=type(e).__name__)
+
+				if not self.is_connection_error(session, e):
+					# * Such as a response which could not be decoded. The session
+					# * is fine and sending the request again would fail the same way
+					raise
+
+				# * The connection is broken. Replace the session and try another
+				if session.dead is not None:
+					session.dead.set()
+
+				if session in self.live:
+					self.live.remove(session)
+
+				if attempt == MAX_ATTEMPTS - 1:
+					raise
+			finally:
+				session.in_flight -= 1
+
+			await anyio.sleep(RETRY_DELAY)
+
+@contextlib.asynccontextmanager
+async def start_session_pool(settings, host: str, port: int, credentials: list[tuple[str, str]], sessions_per_account: int):
+	pool = SessionPool(settings, host, port, credentials, sessions_per_account)
+
+	async with anyio.create_task_group() as tg:
+		for session in pool.sessions:
+			tg.start_soon(pool.maintain, session)
+
+		try:
+			yield pool
+		finally:
+			tg.cancel_scope.cancel()